@@ -7,73 +7,57 @@ async web application
 
 import logging
 import asyncio
-import os
-import time
-from datetime import datetime
 
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
 
+import assets
 import myorm
-from webframe import add_routes, add_static, logger_factory, response_factory, auth_factory
+import jsonutil
+import templating
+from webframe import add_routes, add_static, add_assets, logger_factory, page_cache_factory, compress_factory, response_factory, auth_factory
 from configloader import configs
+from sqlprofiler import SQLProfiler
+from handlers import view_counter, counters
 
 logging.basicConfig(level=logging.INFO)
 
 
 def init_jinja2(app, **kw):
     logging.info('init jinja2...')
-    options = dict(
-        autoescape=kw.get('autoescape', True),
-        auto_reload=kw.get('auto_reload', True)
-    )
-    path = kw.get('path', None)
-    if path is None:
-        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+    path = kw.pop('path', None) or templating.TEMPLATE_PATH
     logging.info('set jinja2 template path: %s' % path)
-    env = Environment(loader=FileSystemLoader(path), **options)
-    filters = kw.get('filters', None)
-    if filters is not None:
-        for name, f in filters.items():
-            env.filters[name] = f
-    app['__template_env__'] = env
+    app['__template_env__'] = templating.create_env(path, **kw)
 
 
-def deltatime_filter(t):
-    '''
-    jinja2自定义过滤器
-    '''
-    delta = int(time.time() - t)
-    if delta < 60:
-        return u'1分钟前'
-    if delta < 3600:
-        return u'%s分钟前' % (delta // 60)
-    if delta < 86400:
-        return u'%s小时前' % (delta // 3600)
-    if delta < 604800:
-        return u'%s天前' % (delta // 86400)
-    dt = datetime.fromtimestamp(t)
-    return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
-
-
-def date_filter(t):
-    '''
-    jinjia2自定义过滤器，以“年－月－日”格式显示日期
-    '''
-    dt = datetime.fromtimestamp(t)
-    return u'%s-%s-%s' % (dt.year, dt.month, dt.day)
-
 async def on_close(app):
+    counters.close()
+    await view_counter.close()
     await myorm.close_pool()
 
 async def init(loop):
     rs = dict()
     await myorm.create_pool(loop, **configs.database)
-    app = web.Application(loop=loop, middlewares=[logger_factory, response_factory, auth_factory])
+    jsonutil.set_backend(configs.json.backend)
+    if configs.sql_profiler.enable:
+        myorm.set_profiler(SQLProfiler(sample_rate=configs.sql_profiler.sample_rate,
+                                       slow_ms=configs.sql_profiler.slow_ms,
+                                       explain=configs.sql_profiler.explain))
+    app = web.Application(loop=loop, middlewares=[logger_factory, page_cache_factory, compress_factory, response_factory, auth_factory])
     app.on_shutdown.append(on_close)
-    init_jinja2(app, filters=dict(deltatime=deltatime_filter, date=date_filter))
+    static_assets = assets.Assets()
+    if configs.assets.build_on_start:
+        assets.build()
+    try:
+        static_assets.load()
+    except FileNotFoundError:
+        logging.warning('assets not built, run ./assets.py, use /static/ urls')
+    init_jinja2(app, globals=dict(static_url=static_assets.url), production=configs.template.production,
+                compiled=templating.COMPILED_PATH if configs.template.precompiled else None)
     add_routes(app, 'handlers')
+    view_counter.start(loop)
+    counters.start(loop)
     add_static(app)
+    add_assets(app, static_assets)
     handler = app.make_handler()
     srv = await loop.create_server(handler, '127.0.0.1', 9000)
     logging.info('server started at http://127.0.0.1:9000...')
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+'''
+Static asset pipeline, usage: ./assets.py
+
+Copy files of www/static (except upload/) to www/static-build with a content hash in
+the file name, write precompressed .gz/.br siblings and manifest.json. Urls in css
+files are rewritten to the fingerprinted names. Templates get the urls by
+static_url('css/main.css'), and the files are served from memory under /assets/.
+'''
+
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import posixpath
+import re
+
+import compress
+
+logging.basicConfig(level=logging.INFO)
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+STATIC_PATH = os.path.join(BASE_PATH, 'static')
+BUILD_PATH = os.path.join(BASE_PATH, 'static-build')
+SKIP_DIRS = ('upload',)
+# 预压缩只做一次，使用最高压缩级别
+LEVELS = dict(gzip=9, br=11)
+SUFFIXES = dict(gzip='.gz', br='.br')
+
+_RE_CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+_RE_URL_PATH = re.compile(r'([^?#]*)(.*)')
+
+
+def fingerprint(path, data):
+    '''
+    >>> fingerprint('css/main.css', b'body {}')
+    'css/main.40294f6c20.css'
+    '''
+    root, ext = posixpath.splitext(path)
+    return '%s.%s%s' % (root, hashlib.sha1(data).hexdigest()[:10], ext)
+
+
+def list_files(src):
+    L = []
+    for root, dirs, files in os.walk(src):
+        dirs[:] = [d for d in dirs if d not in SKIP_DIRS and not d.startswith('.')]
+        for f in files:
+            if not f.startswith('.'):
+                L.append(os.path.relpath(os.path.join(root, f), src).replace(os.sep, '/'))
+    # css最后处理，其引用的文件已确定指纹
+    return sorted(L, key=lambda p: (p.endswith('.css'), p))
+
+
+def rewrite_css(path, data, files):
+    def repl(m):
+        url = m.group(2)
+        if ':' in url or url.startswith('/'):
+            return m.group(0)
+        # 保留?v=...和#...部分
+        target, rest = _RE_URL_PATH.match(url).groups()
+        logical = posixpath.normpath(posixpath.join(posixpath.dirname(path), target))
+        fp = files.get(logical)
+        if fp is None:
+            return m.group(0)
+        return 'url(%s%s%s%s)' % (m.group(1), posixpath.relpath(fp, posixpath.dirname(path)), rest, m.group(1))
+    return _RE_CSS_URL.sub(repl, data.decode('utf-8')).encode('utf-8')
+
+
+def build(src=STATIC_PATH, dst=BUILD_PATH):
+    '''
+    Build fingerprinted and precompressed assets, return the manifest {path: fingerprinted path}.
+    Files of the previous build are kept, so pages cached by browsers still find their assets,
+    older files are removed.
+    '''
+    files = dict()
+    os.makedirs(dst, exist_ok=True)
+    previous = read_manifest(dst)
+    for path in list_files(src):
+        with open(os.path.join(src, path), 'rb') as f:
+            data = f.read()
+        if path.endswith('.css'):
+            data = rewrite_css(path, data, files)
+        fp = files[path] = fingerprint(path, data)
+        target = os.path.join(dst, fp)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        outputs = [(target, None)]
+        if compress.compressible(mimetypes.guess_type(path)[0]):
+            outputs.extend((target + SUFFIXES[encoding], encoding) for encoding in compress.ENCODINGS)
+        for name, encoding in outputs:
+            # 文件名包含内容哈希，已存在的文件内容相同
+            if os.path.exists(name):
+                continue
+            with open(name + '.tmp', 'wb') as f:
+                f.write(data if encoding is None else compress.compress(data, encoding, LEVELS[encoding]))
+            os.replace(name + '.tmp', name)
+            logging.info('build asset: %s => %s' % (path, os.path.relpath(name, dst)))
+    with open(os.path.join(dst, 'manifest.json.tmp'), 'w') as f:
+        json.dump(files, f, indent=2, sort_keys=True)
+    os.replace(os.path.join(dst, 'manifest.json.tmp'), os.path.join(dst, 'manifest.json'))
+    prune(dst, list(files.values()) + list(previous.values()))
+    return files
+
+
+def read_manifest(dst=BUILD_PATH):
+    try:
+        with open(os.path.join(dst, 'manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict()
+
+
+def prune(dst, keep):
+    '''
+    Remove files of dst which are not fingerprinted paths in keep or their compressed variants.
+    '''
+    keep = set(os.path.normpath(os.path.join(dst, fp + suffix)) for fp in keep for suffix in [''] + list(SUFFIXES.values()))
+    keep.add(os.path.normpath(os.path.join(dst, 'manifest.json')))
+    for root, dirs, names in os.walk(dst, topdown=False):
+        for name in names:
+            path = os.path.normpath(os.path.join(root, name))
+            if path not in keep:
+                os.remove(path)
+                logging.info('prune asset: %s' % os.path.relpath(path, dst))
+        # 删除清空的目录
+        if root != dst and not os.listdir(root):
+            os.rmdir(root)
+
+
+class Assets(object):
+    '''
+    Fingerprinted assets loaded in memory, with the precompressed variants.
+    '''
+
+    def __init__(self, prefix='/assets/', fallback='/static/'):
+        self.prefix = prefix
+        self.fallback = fallback
+        self.files = dict()
+        # 指纹路径 => (content_type, {编码: 内容})，编码None为原文件
+        self._bodies = dict()
+
+    def load(self, dst=BUILD_PATH):
+        with open(os.path.join(dst, 'manifest.json')) as f:
+            files = json.load(f)
+        bodies = dict()
+        for fp in files.values():
+            variants = dict()
+            for encoding, suffix in [(None, '')] + list(SUFFIXES.items()):
+                name = os.path.join(dst, fp + suffix)
+                if os.path.exists(name):
+                    with open(name, 'rb') as f:
+                        variants[encoding] = f.read()
+            bodies[fp] = (mimetypes.guess_type(fp)[0] or 'application/octet-stream', variants)
+        self.files, self._bodies = files, bodies
+        logging.info('load %s assets from %s' % (len(files), dst))
+
+    def url(self, path):
+        '''
+        Url of static file path, such as 'css/main.css', not fingerprinted if not built.
+        '''
+        path = path.lstrip('/')
+        fp = self.files.get(path)
+        return self.prefix + fp if fp is not None else self.fallback + path
+
+    def get(self, fp):
+        '''
+        Return (content_type, {encoding: body}) of fingerprinted path, None if not found.
+        '''
+        return self._bodies.get(fp)
+
+
+if __name__ == '__main__':
+    files = build()
+    print('%s assets built in %s' % (len(files), BUILD_PATH))
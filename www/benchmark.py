@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+'''
+Micro benchmarks, usage: ./benchmark.py [name ...]
+'''
+
+import asyncio
+import json
+import logging
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+from urllib import parse
+
+from aiohttp.test_utils import make_mocked_request
+
+from model import Blog
+import jsonutil
+import templating
+from configloader import configs
+from webframe import Page, RequestHandler
+
+
+def log(s):
+    print('[Benchmark] %s' % s)
+
+
+def blog_rows(n):
+    rows = []
+    for i in range(n):
+        rows.append(dict(id='%050d' % i, user_id='u' * 50, user_name='admin', user_image='/static/images/user.svg',
+                         cat_id='c' * 50, cat_name='python', view_count=i, title='title %d' % i,
+                         summary='s' * 200, content='c' * 2000, created_at=time.time()))
+    return rows
+
+
+def measure_memory(fn):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objs = fn()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return objs, after - before
+
+
+def bench_rows(n=10000):
+    '''
+    Compare Model objects with compact rows: build, memory, attribute access and json.dumps.
+    '''
+    rows = blog_rows(n)
+    for name, make in (('Model', Blog), ('Row', Blog.__row__)):
+        objs, mem = measure_memory(lambda: [make(**r) for r in rows])
+        build = timeit.timeit(lambda: [make(**r) for r in rows], number=5) / 5
+        access = timeit.timeit(lambda: [o.title for o in objs], number=20) / 20
+        dumps = timeit.timeit(lambda: json.dumps(objs, ensure_ascii=False, default=jsonutil.default), number=5) / 5
+        log('%-5s x %d: memory %.1f KB (%.0f B/row, values excluded), build %.2f ms, getattr %.2f ms, json %.2f ms' %
+            (name, n, mem / 1024, mem / n, build * 1000, access * 1000, dumps * 1000))
+
+
+class LegacyRequestHandler(RequestHandler):
+    '''
+    Argument binding before it was compiled at add_route time, kept for comparison.
+    '''
+
+    async def __call__(self, request):
+        kw = None
+        if self._has_var_kw_arg or self._has_named_kw_arg or self._required_kw_args:
+            if request.method == 'GET':
+                qs = request.query_string
+                if qs:
+                    kw = dict()
+                    for k, v in parse.parse_qs(qs, True).items():
+                        kw[k] = v[0]
+        if kw is None:
+            kw = dict(**request.match_info)
+        else:
+            if not self._has_var_kw_arg and self._named_kw_args:
+                copy = dict()
+                for name in self._named_kw_args:
+                    if name in kw:
+                        copy[name] = kw[name]
+                kw = copy
+            for k, v in request.match_info.items():
+                if k in kw:
+                    logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
+                kw[k] = v
+        if self._has_request_arg:
+            kw['request'] = request
+        if self._required_kw_args:
+            for name in self._required_kw_args:
+                if name not in kw:
+                    return 'Missing argument: %s' % name
+        logging.info('call with args: %s' % str(kw))
+        return await self._func(**kw)
+
+
+async def category_handler(id, request, *, page='1', cursor=''):
+    return id
+
+
+async def blog_handler(id, request):
+    return id
+
+
+def bench_binding(n=50000):
+    '''
+    Per-request overhead of RequestHandler argument binding, the handler does nothing.
+    '''
+    # 与生产环境相同，INFO日志不输出到终端，但仍会格式化
+    logging.getLogger().handlers = [logging.NullHandler()]
+    loop = asyncio.new_event_loop()
+    cases = (
+        ('GET /category/{id}?page=2', category_handler, make_mocked_request('GET', '/category/c1?page=2&x=1', match_info=dict(id='c1'))),
+        ('GET /blog/{id}', blog_handler, make_mocked_request('GET', '/blog/b1', match_info=dict(id='b1'))),
+    )
+
+    async def run(handler, request):
+        for i in range(n):
+            await handler(request)
+
+    for name, fn, request in cases:
+        for cls in (LegacyRequestHandler, RequestHandler):
+            handler = cls(None, fn)
+            t = time.perf_counter()
+            loop.run_until_complete(run(handler, request))
+            t = time.perf_counter() - t
+            log('%-26s %-20s %.2f us/request' % (name, cls.__name__, t / n * 1e6))
+    loop.close()
+
+
+def bench_json(n=2000):
+    '''
+    Compare JSON backends on a manage page response with Model objects and compact rows,
+    and the streaming encoder with encoding the whole body at once.
+    '''
+    rows = blog_rows(n)
+    for name, make in (('Model', Blog), ('Row', Blog.__row__)):
+        r = dict(page=Page(n, 1, item_page=n), blogs=[make(**row) for row in rows])
+        for backend in sorted(jsonutil.BACKENDS.keys()):
+            jsonutil.set_backend(backend)
+            size = len(jsonutil.dumps(r))
+            t = timeit.timeit(lambda: jsonutil.dumps(r), number=10) / 10
+            st = timeit.timeit(lambda: b''.join(jsonutil.iterencode(r)), number=10) / 10
+            log('%-5s x %d %-6s: %.1f KB, dumps %.2f ms, iterencode %.2f ms' % (name, n, backend, size / 1024, t * 1000, st * 1000))
+    jsonutil.set_backend('auto')
+
+
+def bench_templates(n=2000):
+    '''
+    Startup (create environment and load all templates) and per-render overhead of
+    development mode, production mode with cold and warm bytecode cache, precompiled templates,
+    and production mode with {% cache %} fragments enabled.
+    '''
+    names = templating.create_env().list_templates()
+    cats = [dict(id='%050d' % i, name='category %d' % i) for i in range(20)]
+    ctx = dict(web_meta=configs.web_meta, cats=cats, user=dict(id='u1', name='admin'), static_url=lambda path: '/static/' + path)
+    with tempfile.TemporaryDirectory() as tmp:
+        compiled = tmp + '/compiled'
+        templating.compile_all(target=compiled)
+        cases = (
+            ('development', dict(fragment_cache=None)),
+            ('production cold', dict(production=True, bytecode_cache=tmp + '/bytecode', fragment_cache=None)),
+            ('production warm', dict(production=True, bytecode_cache=tmp + '/bytecode', fragment_cache=None)),
+            ('precompiled', dict(production=True, bytecode_cache=None, compiled=compiled, fragment_cache=None)),
+            ('fragment cache', dict(production=True, bytecode_cache=tmp + '/bytecode', fragment_cache=templating.FragmentCache())),
+        )
+        for name, kw in cases:
+            t = time.perf_counter()
+            env = templating.create_env(**kw)
+            for tpl in names:
+                env.get_template(tpl)
+            startup = time.perf_counter() - t
+            get = timeit.timeit(lambda: env.get_template('login.html'), number=n) / n
+            render = timeit.timeit(lambda: env.get_template('login.html').render(**ctx), number=n) / n
+            log('%-16s startup %.1f ms (%d templates), get_template %.2f us, get_template+render %.1f us' %
+                (name, startup * 1000, len(names), get * 1e6, render * 1e6))
+
+
+BENCHMARKS = dict(rows=bench_rows, binding=bench_binding, json=bench_json, templates=bench_templates)
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS.keys())
+    for name in names:
+        if name not in BENCHMARKS:
+            print('Unknown benchmark: %s, choose from: %s' % (name, ', '.join(sorted(BENCHMARKS.keys()))))
+            exit(1)
+        log('running %s...' % name)
+        BENCHMARKS[name]()
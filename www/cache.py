@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+'''
+In-process cache helpers.
+'''
+
+import asyncio
+import contextvars
+import functools
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''
+    Size bounded dict, evict the least recently used item when full.
+    If ttl is given, items expire ttl seconds after set.
+
+    >>> c = LRUCache(2)
+    >>> c.set('a', 1)
+    >>> c.set('b', 2)
+    >>> c.get('a')
+    1
+    >>> c.set('c', 3)
+    >>> c.get('b') is None
+    True
+    >>> len(c)
+    2
+    '''
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires is not None and expires < time.time():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        self._data.clear()
+
+
+class CachedValue(object):
+    '''
+    Cache the result of an async loader until invalidate() is called or ttl seconds passed.
+    '''
+
+    def __init__(self, loader, ttl=None):
+        self._loader = loader
+        self.ttl = ttl
+        self._value = None
+        self._loaded = False
+        self._loaded_at = 0
+        self._version = 0
+
+    async def get(self):
+        if self._loaded and (self.ttl is None or time.time() - self._loaded_at < self.ttl):
+            return self._value
+        version = self._version
+        value = await self._loader()
+        # 载入期间被invalidate的结果不缓存
+        if version == self._version:
+            self._value = value
+            self._loaded = True
+            self._loaded_at = time.time()
+        return value
+
+    def invalidate(self):
+        self._version += 1
+        self._value = None
+        self._loaded = False
+
+
+class SingleFlight(object):
+    '''
+    Coalesce concurrent calls with the same key into one in-flight call, the other callers
+    wait for its result or exception. The call runs in its own task, so cancelling any
+    caller, including the one which started it, does not affect the others. Callers give
+    up after timeout seconds with asyncio.TimeoutError, the call itself is not cancelled.
+    '''
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._calls = dict()
+        self.calls = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, fn, *args, **kw):
+        fut = self._calls.get(key)
+        if fut is not None:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            # 在空上下文中运行，不使用发起者固定的数据库连接
+            fut = contextvars.Context().run(asyncio.ensure_future, fn(*args, **kw))
+            self._calls[key] = fut
+            fut.add_done_callback(functools.partial(self._done, key))
+        return await asyncio.wait_for(asyncio.shield(fut), self.timeout)
+
+    def _done(self, key, fut):
+        if self._calls.get(key) is fut:
+            del self._calls[key]
+        # 没有等待者时避免"exception was never retrieved"警告
+        if not fut.cancelled():
+            fut.exception()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+'''
+Response compression helpers, brotli is used only if the brotli package is installed.
+'''
+
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 按优先顺序排列，客户端q值相同时选择靠前的编码
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'image/svg+xml', 'font/ttf', 'font/otf')
+
+
+def compressible(content_type):
+    return content_type is not None and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def negotiate(accept_encoding, encodings=ENCODINGS):
+    '''
+    Choose the encoding from Accept-Encoding header, return None if nothing acceptable.
+
+    >>> negotiate('gzip, deflate', ('br', 'gzip'))
+    'gzip'
+    >>> negotiate('gzip;q=0.5, br', ('br', 'gzip'))
+    'br'
+    >>> negotiate('*;q=0', ('gzip',)) is None
+    True
+    '''
+    if not accept_encoding:
+        return None
+    prefs = dict()
+    for part in accept_encoding.split(','):
+        name, _, params = part.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        prefs[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for enc in encodings:
+        q = prefs.get(enc, prefs.get('*', 0.0))
+        if q > best_q:
+            best, best_q = enc, q
+    return best
+
+
+def compress(data, encoding, level):
+    if encoding == 'gzip':
+        # mtime固定为0，相同内容的压缩结果相同
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if encoding == 'br' and brotli is not None:
+        return brotli.compress(data, quality=level)
+    raise ValueError('Unsupported encoding: %s' % encoding)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+'''
+Denormalized counters kept in the `counters` table, so pagination does not need count(*).
+'''
+
+import asyncio
+import logging
+
+import myorm
+
+logging.basicConfig(level=logging.INFO)
+
+
+class CounterStore(object):
+    '''
+    Counters defined by a name and a count function which computes the real value:
+
+        store.define('blog', lambda: Blog.findNumber('*'))
+        store.define('blog:cat', lambda cat_id: Blog.findNumber('*', 'cat_id=?', [cat_id]))
+
+    get() reads the value from memory or the counters table on the primary database,
+    computing it only when the counter does not exist yet. Write handlers call incr() in the same transaction
+    as the write, the value in memory is dropped after commit. reconcile() corrects
+    the drift every interval seconds.
+    '''
+
+    def __init__(self, table='counters', interval=3600):
+        self.table = table
+        self.interval = interval
+        self._defines = dict()
+        self._values = dict()
+        self._version = 0
+        self._task = None
+
+    def define(self, name, count):
+        self._defines[name] = count
+
+    def _key(self, name, arg):
+        if name not in self._defines:
+            raise ValueError('Counter not defined: %s' % name)
+        return name if arg is None else '%s:%s' % (name, arg)
+
+    async def get(self, name, arg=None):
+        key = self._key(name, arg)
+        value = self._values.get(key)
+        if value is not None:
+            return value
+        version = self._version
+        # 从主库读取，从库延迟时读到的旧值会一直缓存到下次写入
+        rs = await myorm.select('select `value` from `%s` where `name`=?' % self.table, [key], 1, primary=True)
+        if rs:
+            value = rs[0]['value']
+        else:
+            # 初始值同样需要从主库计算，本请求之后的读取也会使用主库
+            myorm.use_primary()
+            value = await self._count(name, arg)
+            await myorm.execute('insert ignore into `%s` (`name`, `value`) values (?, ?)' % self.table, [key, value])
+        # 读取期间计数器被修改过的值不缓存
+        if version == self._version:
+            self._values[key] = value
+        return value
+
+    async def incr(self, name, arg=None, n=1):
+        key = self._key(name, arg)
+        # 计数器不存在时不创建，由get()通过count函数计算初始值
+        await myorm.execute('update `%s` set `value`=`value`+? where `name`=?' % self.table, [n, key])
+        # 下次get()时从数据库读取，事务提交前其他请求可能读到并缓存旧值，提交后再清除一次
+        self._drop(key)
+        myorm.on_commit(lambda: self._drop(key))
+
+    def _drop(self, key):
+        self._version += 1
+        self._values.pop(key, None)
+
+    async def decr(self, name, arg=None, n=1):
+        await self.incr(name, arg, -n)
+
+    async def _count(self, name, arg):
+        count = self._defines[name]
+        return await (count() if arg is None else count(arg))
+
+    async def reconcile(self):
+        '''
+        Recompute all counters in table and fix the drifted ones.
+        '''
+        rs = await myorm.select('select `name` from `%s`' % self.table, [])
+        fixed = 0
+        for r in rs:
+            key = r['name']
+            name, arg = key, None
+            if name not in self._defines:
+                name, _, arg = key.rpartition(':')
+                if name not in self._defines:
+                    continue
+            # 锁定计数器行后再count(*)，并发的incr()等待本事务提交，不会被重复计入
+            async with myorm.transaction():
+                locked = await myorm.select('select `value` from `%s` where `name`=? for update' % self.table, [key])
+                if not locked:
+                    continue
+                value = await self._count(name, arg)
+                if value != locked[0]['value']:
+                    logging.warning('counter %s drifted: %s, real: %s' % (key, locked[0]['value'], value))
+                    await myorm.execute('update `%s` set `value`=? where `name`=?' % self.table, [value, key])
+                    fixed += 1
+            self._drop(key)
+        return fixed
+
+    def start(self, loop):
+        if self._task is None:
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logging.exception(e)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -3,7 +3,6 @@
 
 import re
 import hashlib
-import json
 import logging
 import os
 import smtplib
@@ -15,30 +14,78 @@ from email.utils import parseaddr, formataddr
 from aiohttp import web
 from markdown2 import markdown
 
-from webframe import get, post, user2cookie, Page, filelist
+import myorm
+from webframe import get, post, cache_page, invalidate_pages, page_version, user2cookie, invalidate_user, Page, filelist
+from cache import LRUCache, CachedValue, SingleFlight
+from templating import fragment_cache
+import jsonutil
+from viewcounter import ViewCounter
+from counters import CounterStore
 from model import next_id, User, Blog, Comment, Category
 from configloader import configs
 from APIError import APIError, APIValueError, APIPermissionError, APIResourceNotFoundError
 
 logging.basicConfig(level=logging.INFO)
 
+md_cache = LRUCache(configs.cache.markdown_size)
+# 导航栏使用的分类列表，分类修改时失效，ttl用于兜底应用外的修改，因此不经过查询缓存
+categories = CachedValue(lambda: Category.findAll(orderBy='created_at desc', cache=False), ttl=configs.cache.category_ttl)
+# 分页使用的计数器，写操作在同一事务内更新，定时与count(*)校对，count(*)不经过查询缓存
+counters = CounterStore(interval=configs.counter_reconcile_interval)
+counters.define('blog', lambda: Blog.findNumber('*', cache=False))
+counters.define('blog:cat', lambda cat_id: Blog.findNumber('*', 'cat_id=?', [cat_id], cache=False))
+counters.define('comment', lambda: Comment.findNumber('*', cache=False))
+counters.define('user', lambda: User.findNumber('*', cache=False))
+counters.define('category', lambda: Category.findNumber('*', cache=False))
+# 合并并发的相同页面数据加载
+page_flight = SingleFlight(timeout=configs.cache.single_flight_timeout)
+# 博客阅读数先在内存中累计，定时批量写入数据库
+view_counter = ViewCounter('blog', 'view_count', interval=configs.view_count_flush_interval)
+
+
+def render_markdown(kind, id, text):
+    '''
+    Render markdown text, the html is cached by (kind, id) and re-rendered only if the text changed.
+    '''
+    digest = hashlib.md5(text.encode('utf-8')).hexdigest()
+    cached = md_cache.get((kind, id))
+    if cached is not None and cached[0] == digest:
+        return cached[1]
+    html = markdown(text, extras=['code-friendly', 'fenced-code-blocks'])
+    md_cache.set((kind, id), (digest, html))
+    return html
+
+
+def invalidate_markdown(kind, id):
+    md_cache.pop((kind, id))
+
+
+async def load_index(page_index, cursor):
+    async with myorm.connection(readonly=True):
+        num = await counters.get('blog') - 1    # 去掉__about__页面
+        p = Page(num, page_index, item_page=configs.blog_item_page, page_show=configs.page_show, cursor=cursor)
+        p.pagelist()
+        if num == 0:
+            blogs = []
+        else:
+            blogs = await Blog.findAll(where='title<>?', args=['__about__'], **p.findArgs())
+            p.setCursors(blogs)
+    for blog in blogs:
+        blog.html_summary = render_markdown('summary', blog.id, blog.summary)
+    return p, blogs
+
 
 @get('/')
-async def index(request, *, page='1'):
+@cache_page()
+async def index(request, *, page='1', cursor=''):
     user = request.__user__
-    cats = await Category.findAll(orderBy='created_at desc')
+    cats = await categories.get()
     page_index = Page.page2int(page)
-    num = await Blog.findNumber('*') - 1    # 去掉__about__页面
-    p = Page(num, page_index, item_page=configs.blog_item_page, page_show=configs.page_show)
-    p.pagelist()
-    if num == 0:
-        blogs = []
-    else:
-        blogs = await Blog.findAll(where='title<>?', args=['__about__'], orderBy='created_at desc', limit=(p.offset, p.limit))
-        for blog in blogs:
-            blog.html_summary = markdown(blog.summary, extras=['code-friendly', 'fenced-code-blocks'])
+    # 并发的相同请求只查询和渲染markdown一次，p和blogs在这些请求间共享，不可修改
+    p, blogs = await page_flight.do(('index', page_index, cursor, page_version()), load_index, page_index, cursor)
     return {
         '__template__': 'index.html',
+        '__render_key__': ('index', page_index, cursor, user and user.id),
         'web_meta': configs.web_meta,
         'user': user,
         'cats': cats,
@@ -49,12 +96,13 @@ async def index(request, *, page='1'):
 
 
 @get('/about')
+@cache_page()
 async def about(request):
     user = request.__user__
-    cats = await Category.findAll(orderBy='created_at desc')
-    blog = await Blog.findAll(where='title=?', args=['__about__'])
+    cats = await categories.get()
+    blog = await Blog.findAll(where='title=?', args=['__about__'], undefer=True)
     logging.info('blog: %s' % blog)
-    blog[0].html_content = markdown(blog[0].content, extras=['code-friendly', 'fenced-code-blocks'])
+    blog[0].html_content = render_markdown('content', blog[0].id, blog[0].content)
     return {
         '__template__': 'about.html',
         'web_meta': configs.web_meta,
@@ -66,7 +114,7 @@ async def about(request):
 
 @get('/signup')
 async def signin():
-    cats = await Category.findAll(orderBy='created_at desc')
+    cats = await categories.get()
     return {
         '__template__': 'signup.html',
         'web_meta': configs.web_meta,
@@ -76,7 +124,7 @@ async def signin():
 
 @get('/login')
 async def login():
-    cats = await Category.findAll(orderBy='created_at desc')
+    cats = await categories.get()
     return {
         '__template__': 'login.html',
         'web_meta': configs.web_meta,
@@ -93,19 +141,38 @@ async def logout(request):
     return r
 
 
+async def load_blog(id):
+    async with myorm.connection(readonly=True):
+        blog = await Blog.find(id)
+        if blog is None:
+            return None, None
+        comments = await Comment.findAll(where='blog_id=?', args=[id], orderBy='created_at desc')
+    for c in comments:
+        c.html_content = render_markdown('comment', c.id, c.content)
+    blog.html_content = render_markdown('content', blog.id, blog.content)
+    return blog, comments
+
+
+def count_view(request):
+    # 从整页缓存返回博客页面时也要计数
+    view_counter.incr(request.match_info['id'])
+
+
 @get('/blog/{id}')
+@cache_page(on_hit=count_view)
 async def get_blog(id, request):
     user = request.__user__
-    cats = await Category.findAll(orderBy='created_at desc')
-    blog = await Blog.find(id)
-    blog.view_count = blog.view_count + 1
-    await blog.update()
-    comments = await Comment.findAll(where='blog_id=?', args=[id], orderBy='created_at desc')
-    for c in comments:
-        c.html_content = markdown(c.content, extras=['code-friendly', 'fenced-code-blocks'])
-    blog.html_content = markdown(blog.content, extras=['code-friendly', 'fenced-code-blocks'])
+    cats = await categories.get()
+    blog, comments = await page_flight.do(('blog', id, page_version()), load_blog, id)
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    # blog在并发请求间共享，复制后再修改阅读数
+    blog = Blog(**blog)
+    view_counter.incr(id)
+    blog.view_count = blog.view_count + view_counter.pending(id)
     return {
         '__template__': 'blog.html',
+        '__render_key__': ('blog', id, user and user.id),
         'web_meta': configs.web_meta,
         'user': user,
         'cats': cats,
@@ -118,7 +185,7 @@ async def get_blog(id, request):
 @get('/user/{id}')
 async def get_user(id, request):
     user = request.__user__
-    cats = await Category.findAll(orderBy='created_at desc')
+    cats = await categories.get()
     user_show = await User.find(id)
     user_show.password = '******'
     return {
@@ -130,23 +197,33 @@ async def get_user(id, request):
     }
 
 
+async def load_category(id, page_index, cursor):
+    async with myorm.connection(readonly=True):
+        category = await Category.find(id)
+        # 不存在的分类不创建计数器
+        num = await counters.get('blog:cat', id) if category else 0
+        p = Page(num, page_index, item_page=configs.blog_item_page, page_show=configs.page_show, cursor=cursor)
+        p.pagelist()
+        if num == 0:
+            blogs = []
+        else:
+            blogs = await Blog.findAll(where='cat_id=?', args=[id], **p.findArgs())
+            p.setCursors(blogs)
+    for blog in blogs:
+        blog.html_summary = render_markdown('summary', blog.id, blog.summary)
+    return category, p, blogs
+
+
 @get('/category/{id}')
-async def get_category(id, request, *, page='1'):
+@cache_page()
+async def get_category(id, request, *, page='1', cursor=''):
     user = request.__user__
-    cats = await Category.findAll(orderBy='created_at desc')
-    category = await Category.find(id)
+    cats = await categories.get()
     page_index = Page.page2int(page)
-    num = await Blog.findNumber('*', 'cat_id=?', [id])
-    p = Page(num, page_index, item_page=configs.blog_item_page, page_show=configs.page_show)
-    p.pagelist()
-    if num == 0:
-        blogs = []
-    else:
-        blogs = await Blog.findAll(where='cat_id=?', args=[id], orderBy='created_at desc', limit=(p.offset, p.limit))
-        for blog in blogs:
-            blog.html_summary = markdown(blog.summary, extras=['code-friendly', 'fenced-code-blocks'])
+    category, p, blogs = await page_flight.do(('category', id, page_index, cursor, page_version()), load_category, id, page_index, cursor)
     return {
         '__template__': 'category.html',
+        '__render_key__': ('category', id, page_index, cursor, user and user.id),
         'web_meta': configs.web_meta,
         'user': user,
         'cats': cats,
@@ -165,38 +242,41 @@ async def api_blog(*, id):
 
 # handler带有默认值的命名关键字参数，用来处理带有查询字符串的url
 @get('/api/manage/blog')
-async def api_manage_blog(*, page='1'):
+async def api_manage_blog(*, page='1', cursor=''):
     page_index = Page.page2int(page)
-    num = await Blog.findNumber('*')
-    p = Page(num, page_index, item_page=configs.manage_item_page, page_show=configs.page_show)
+    num = await counters.get('blog')
+    p = Page(num, page_index, item_page=configs.manage_item_page, page_show=configs.page_show, cursor=cursor)
     if num == 0:
         return dict(page=p, blogs=())
     col = ['id', 'user_id', 'user_name', 'title', 'created_at']
-    blogs = await Blog.findAll(col=col, orderBy='created_at desc', limit=(p.offset, p.limit))
+    blogs = await Blog.findAll(col=col, compact=True, **p.findArgs())
+    p.setCursors(blogs)
     return dict(page=p, blogs=blogs)
 
 
 # handler带有默认值的命名关键字参数，用来处理带有查询字符串的url
 @get('/api/manage/comment')
-async def api_manage_comment(*, page='1'):
+async def api_manage_comment(*, page='1', cursor=''):
     page_index = Page.page2int(page)
-    num = await Comment.findNumber('*')
-    p = Page(num, page_index, item_page=configs.manage_item_page, page_show=configs.page_show)
+    num = await counters.get('comment')
+    p = Page(num, page_index, item_page=configs.manage_item_page, page_show=configs.page_show, cursor=cursor)
     if num == 0:
         return dict(page=p, comments=())
-    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    comments = await Comment.findAll(compact=True, **p.findArgs())
+    p.setCursors(comments)
     return dict(page=p, comments=comments)
 
 
 # handler带有默认值的命名关键字参数，用来处理带有查询字符串的url
 @get('/api/manage/user')
-async def api_manage_user(*, page='1'):
+async def api_manage_user(*, page='1', cursor=''):
     page_index = Page.page2int(page)
-    num = await User.findNumber('*')
-    p = Page(num, page_index, item_page=configs.manage_item_page, page_show=configs.page_show)
+    num = await counters.get('user')
+    p = Page(num, page_index, item_page=configs.manage_item_page, page_show=configs.page_show, cursor=cursor)
     if num == 0:
         return dict(page=p, user=())
-    users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    users = await User.findAll(compact=True, **p.findArgs())
+    p.setCursors(users)
     for u in users:
         u.password = '******'
     return dict(page=p, users=users)
@@ -204,14 +284,15 @@ async def api_manage_user(*, page='1'):
 
 # handler带有默认值的命名关键字参数，用来处理带有查询字符串的url
 @get('/api/manage/category')
-async def api_manage_category(*, page='1'):
+async def api_manage_category(*, page='1', cursor=''):
     page_index = Page.page2int(page)
-    num = await Category.findNumber('*')
-    p = Page(num, page_index, item_page=configs.manage_item_page, page_show=configs.page_show)
+    num = await counters.get('category')
+    p = Page(num, page_index, item_page=configs.manage_item_page, page_show=configs.page_show, cursor=cursor)
     if num == 0:
         return dict(page=p, categories=())
-    categories = await Category.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
-    return dict(page=p, categories=categories)
+    cats = await Category.findAll(compact=True, **p.findArgs())
+    p.setCursors(cats)
+    return dict(page=p, categories=cats)
 
 
 @get('/api/category/{id}')
@@ -223,7 +304,7 @@ async def api_category(*, id):
 @get('/manage')
 async def manage_ajax(request, *, page='1'):
     user = request.__user__
-    cats = await Category.findAll(orderBy='created_at desc')
+    cats = await categories.get()
     # 设置Page类缺省值
     p = Page(1, 1, item_page=configs.manage_item_page, page_show=configs.page_show)
     return {
@@ -238,7 +319,7 @@ async def manage_ajax(request, *, page='1'):
 @get('/manage/blog/create')
 async def manage_blog_create(request):
     user = request.__user__
-    cats = await Category.findAll(orderBy='created_at desc')
+    cats = await categories.get()
     return {
         '__template__': 'manage_blog_edit.html',
         'web_meta': configs.web_meta,
@@ -252,7 +333,7 @@ async def manage_blog_create(request):
 @get('/manage/blog/edit')
 async def manage_blog_edit(request, *, id):
     user = request.__user__
-    cats = await Category.findAll(orderBy='created_at desc')
+    cats = await categories.get()
 
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static/upload')
     uploadlist = filelist(path)
@@ -270,7 +351,7 @@ async def manage_blog_edit(request, *, id):
 @get('/manage/category/create')
 async def manage_category_create(request):
     user = request.__user__
-    cats = await Category.findAll(orderBy='created_at desc')
+    cats = await categories.get()
     return {
         '__template__': 'manage_category_edit.html',
         'web_meta': configs.web_meta,
@@ -284,7 +365,7 @@ async def manage_category_create(request):
 @get('/manage/category/edit')
 async def manage_category_edit(request, *, id):
     user = request.__user__
-    cats = await Category.findAll(orderBy='created_at desc')
+    cats = await categories.get()
     return {
         '__template__': 'manage_category_edit.html',
         'web_meta': configs.web_meta,
@@ -316,6 +397,7 @@ async def api_reset_password(*, email):
     sha1_password = '%s:%s' % (user.id, password1)
     user.password = hashlib.sha1(sha1_password.encode('utf-8')).hexdigest()
     await user.update()
+    invalidate_user(user.id)
 
     # 发送email
     from_addr = configs.email.addr
@@ -354,13 +436,15 @@ async def api_signin(*, email, name, password):
     uid = next_id()
     sha1_password = '%s:%s' % (uid, password)
     user = User(id=uid, name=name.strip(), email=email, password=hashlib.sha1(sha1_password.encode('utf-8')).hexdigest(), image=configs.web_meta.user_image)
-    await user.save()
+    async with myorm.transaction():
+        await user.save()
+        await counters.incr('user')
     # 设置cookie
     r = web.Response()
     r.set_cookie(configs.cookie.name, user2cookie(user, configs.cookie.max_age), max_age=configs.cookie.max_age, httponly=True)
     user.password = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = jsonutil.dumps(user)
     return r
 
 
@@ -392,7 +476,7 @@ async def api_login(*, email, password, rememberme):
     r.set_cookie(configs.cookie.name, user2cookie(user, max_age), max_age=max_age, httponly=True)
     user.password = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = jsonutil.dumps(user)
     return r
 
 
@@ -416,7 +500,12 @@ async def api_create_blog(request, *, title, summary, content, cat_name):
             raise APIValueError('cat_name', 'cat_name is not belong to Category.')
         cat_id = cats[0].id
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, title=title.strip(), summary=summary.strip(), content=content.strip(), cat_id=cat_id, cat_name=cat_name.strip())
-    await blog.save()
+    async with myorm.transaction():
+        await blog.save()
+        await counters.incr('blog')
+        if cat_id:
+            await counters.incr('blog:cat', cat_id)
+    invalidate_pages()
     return blog
 
 
@@ -433,6 +522,7 @@ async def api_update_blog(id, request, *, title, summary, content, cat_name):
     if not content or not content.strip():
         raise APIValueError('content', 'Content can not be empty.')
     blog = await Blog.find(id)
+    old_cat_id = blog.cat_id
     blog.title = title.strip()
     blog.summary = summary.strip()
     blog.content = content.strip()
@@ -445,7 +535,16 @@ async def api_update_blog(id, request, *, title, summary, content, cat_name):
         if (len(cats) == 0):
             raise APIValueError('cat_name', 'cat_name is not belong to Category.')
         blog.cat_id = cats[0].id
-    await blog.update()
+    async with myorm.transaction():
+        await blog.update()
+        if blog.cat_id != old_cat_id:
+            if old_cat_id:
+                await counters.decr('blog:cat', old_cat_id)
+            if blog.cat_id:
+                await counters.incr('blog:cat', blog.cat_id)
+    invalidate_markdown('summary', id)
+    invalidate_markdown('content', id)
+    invalidate_pages()
     return blog
 
 
@@ -456,7 +555,14 @@ async def api_delete_blog(request, *, id):
     blog = await Blog.find(id)
     if blog is None:
         raise APIResourceNotFoundError('Blog')
-    await blog.remove()
+    async with myorm.transaction():
+        await blog.remove()
+        await counters.decr('blog')
+        if blog.cat_id:
+            await counters.decr('blog:cat', blog.cat_id)
+    invalidate_markdown('summary', id)
+    invalidate_markdown('content', id)
+    invalidate_pages()
     return dict(id=id)
 
 
@@ -471,7 +577,10 @@ async def api_create_comment(id, request, *, content):
     if blog is None:
         raise APIResourceNotFoundError('Blog')
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
-    await comment.save()
+    async with myorm.transaction():
+        await comment.save()
+        await counters.incr('comment')
+    invalidate_pages()
     return comment
 
 
@@ -482,7 +591,11 @@ async def api_delete_comment(id, request):
     comment = await Comment.find(id)
     if comment is None:
         raise APIResourceNotFoundError('Comment')
-    await comment.remove()
+    async with myorm.transaction():
+        await comment.remove()
+        await counters.decr('comment')
+    invalidate_markdown('comment', id)
+    invalidate_pages()
     return dict(id=id)
 
 
@@ -493,7 +606,10 @@ async def api_delete_user(id, request):
     user = await User.find(id)
     if user is None:
         raise APIResourceNotFoundError('User')
-    await user.remove()
+    async with myorm.transaction():
+        await user.remove()
+        await counters.decr('user')
+    invalidate_user(id)
     return dict(id=id)
 
 
@@ -522,7 +638,12 @@ async def api_create_category(request, *, name):
     if not name or not name.strip():
         raise APIValueError('name', 'Name can not be empty.')
     cat = Category(name=name.strip())
-    await cat.save()
+    async with myorm.transaction():
+        await cat.save()
+        await counters.incr('category')
+    categories.invalidate()
+    fragment_cache.invalidate('sidebar')
+    invalidate_pages()
     return cat
 
 
@@ -535,6 +656,9 @@ async def api_update_category(id, request, *, name):
     cat = await Category.find(id)
     cat.name = name.strip()
     await cat.update()
+    categories.invalidate()
+    fragment_cache.invalidate('sidebar')
+    invalidate_pages()
     return cat
 
 
@@ -545,7 +669,12 @@ async def api_delete_category(id, request):
     cat = await Category.find(id)
     if cat is None:
         raise APIResourceNotFoundError('Category')
-    await cat.remove()
+    async with myorm.transaction():
+        await cat.remove()
+        await counters.decr('category')
+    categories.invalidate()
+    fragment_cache.invalidate('sidebar')
+    invalidate_pages()
     return dict(id=id)
 
 
@@ -582,4 +711,5 @@ async def api_modify_password(request, *, user_id, password0, password1, passwor
     sha1_password = '%s:%s' % (user_id, password1)
     user.password = hashlib.sha1(sha1_password.encode('utf-8')).hexdigest()
     await user.update()
+    invalidate_user(user.id)
     return dict(user_id=user_id)
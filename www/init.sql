@@ -32,7 +32,8 @@ create table blog (
     `summary` varchar(200) not null,
     `content` text not null,
     `created_at` real not null,
-    key `idx_created_at` (`created_at`)
+    key `idx_created_at` (`created_at`),
+    key `idx_cat_id_created_at` (`cat_id`, `created_at`)
 ) engine=innodb default charset=utf8;
 
 create table comment (
@@ -43,7 +44,8 @@ create table comment (
     `user_image` varchar(500) not null,
     `content` text not null,
     `created_at` real not null,
-    key `idx_created_at` (`created_at`)
+    key `idx_created_at` (`created_at`),
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`)
 ) engine=innodb default charset=utf8;
 
 create table category (
@@ -54,5 +56,10 @@ create table category (
     key `idx_created_at` (`created_at`)
 ) engine=innodb default charset=utf8;
 
+create table counters (
+    `name` varchar(100) not null primary key,
+    `value` bigint not null
+) engine=innodb default charset=utf8;
+
 insert into user (id,email,admin,name,image,created_at,password) values ("001509031623528dfbb1f415a584f238c22fb23359afb18000","admin@example.com",1,"admin","/static/images/user.svg",unix_timestamp(),"e123fe7fa6d63d04254687a1a026f14770fa162d");
 
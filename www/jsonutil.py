@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+'''
+JSON serialization used by API responses, the backend is the standard json module
+or orjson if installed, choose with set_backend('auto' | 'orjson' | 'json').
+
+Model objects are dicts and encoded directly, compact rows by _asdict() and other
+objects such as Page by their public attributes. Responses containing a list of at least
+stream_items items are written in chunks by stream_response().
+'''
+
+import json
+import logging
+
+from aiohttp import web
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logging.basicConfig(level=logging.INFO)
+
+
+def default(o):
+    # Model.findAll(compact=True)返回的行对象没有__dict__
+    if hasattr(o, '_asdict'):
+        return o._asdict()
+    try:
+        # 下划线开头的属性不输出
+        return {k: v for k, v in vars(o).items() if not k.startswith('_')}
+    except TypeError:
+        raise TypeError('Object of type %s is not JSON serializable' % o.__class__.__name__)
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=default).encode('utf-8')
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+
+BACKENDS = dict(json=_json_dumps)
+if orjson is not None:
+    BACKENDS['orjson'] = _orjson_dumps
+
+_dumps = _json_dumps
+backend = 'json'
+
+
+def set_backend(name='auto'):
+    global _dumps, backend
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name not in BACKENDS:
+        raise ValueError('JSON backend not available: %s' % name)
+    _dumps = BACKENDS[name]
+    backend = name
+    logging.info('use json backend: %s' % name)
+
+
+def dumps(obj):
+    '''
+    Encode obj to utf-8 JSON bytes.
+    '''
+    return _dumps(obj)
+
+
+def is_large(obj, stream_items):
+    '''
+    Whether obj is a dict or list containing a list of at least stream_items items.
+    '''
+    if isinstance(obj, (list, tuple)):
+        return len(obj) >= stream_items
+    if isinstance(obj, dict):
+        for v in obj.values():
+            if isinstance(v, (list, tuple, dict)) and is_large(v, stream_items):
+                return True
+    return False
+
+
+def iterencode(obj, chunk_items=500):
+    '''
+    Yield JSON bytes of obj piece by piece, lists are encoded chunk_items items at a time.
+    '''
+    if isinstance(obj, (list, tuple)):
+        yield b'['
+        for i in range(0, len(obj), chunk_items):
+            if i:
+                yield b','
+            # 去掉分块结果两端的方括号
+            yield _dumps(obj[i:i + chunk_items])[1:-1]
+        yield b']'
+    elif isinstance(obj, dict) and obj.__class__ is dict:
+        yield b'{'
+        for i, (k, v) in enumerate(obj.items()):
+            if i:
+                yield b','
+            yield _dumps(str(k))
+            yield b':'
+            yield from iterencode(v, chunk_items)
+        yield b'}'
+    else:
+        yield _dumps(obj)
+
+
+async def stream_response(request, obj, chunk_items=500, buffer_size=65536):
+    '''
+    Write obj as a chunked JSON response, without building the whole body in memory.
+    '''
+    resp = web.StreamResponse()
+    resp.content_type = 'application/json'
+    resp.charset = 'utf-8'
+    resp.enable_chunked_encoding()
+    resp.enable_compression()
+    await resp.prepare(request)
+    buf = []
+    size = 0
+    for s in iterencode(obj, chunk_items):
+        buf.append(s)
+        size += len(s)
+        if size >= buffer_size:
+            await resp.write(b''.join(buf))
+            buf = []
+            size = 0
+    if buf:
+        await resp.write(b''.join(buf))
+    await resp.write_eof()
+    return resp
+
+
+set_backend('auto')
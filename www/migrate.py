@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+'''
+Compare indexes and columns declared in model.py with the live database and print
+the DDL needed to migrate, usage: ./migrate.py [--drop]
+
+Tables not in database are printed as CREATE TABLE statements. Indexes in database
+but not declared in models are printed as comments, unless --drop is given.
+'''
+
+import asyncio
+import logging
+import sys
+
+import myorm
+import model
+from myorm import Model, Index
+from configloader import configs
+
+logging.basicConfig(level=logging.WARNING)
+
+
+def find_models(mod):
+    L = []
+    for attr in dir(mod):
+        m = getattr(mod, attr)
+        if isinstance(m, type) and issubclass(m, Model) and m is not Model:
+            L.append(m)
+    return L
+
+
+async def live_tables(db):
+    rs = await myorm.select('select `TABLE_NAME` from information_schema.TABLES where `TABLE_SCHEMA`=?', [db])
+    return set(r['TABLE_NAME'] for r in rs)
+
+
+async def live_columns(db, table):
+    rs = await myorm.select('select `COLUMN_NAME` from information_schema.COLUMNS where `TABLE_SCHEMA`=? and `TABLE_NAME`=?', [db, table])
+    return set(r['COLUMN_NAME'] for r in rs)
+
+
+async def live_indexes(db, table):
+    rs = await myorm.select('select `INDEX_NAME`, `COLUMN_NAME`, `NON_UNIQUE` from information_schema.STATISTICS '
+                            'where `TABLE_SCHEMA`=? and `TABLE_NAME`=? order by `INDEX_NAME`, `SEQ_IN_INDEX`', [db, table])
+    columns = dict()
+    unique = dict()
+    for r in rs:
+        if r['INDEX_NAME'] == 'PRIMARY':
+            continue
+        columns.setdefault(r['INDEX_NAME'], []).append(r['COLUMN_NAME'])
+        unique[r['INDEX_NAME']] = not int(r['NON_UNIQUE'])
+    return {name: Index(*cols, name=name, unique=unique[name]) for name, cols in columns.items()}
+
+
+def create_table(m):
+    '''
+    CREATE TABLE statement of model m, columns without default value are nullable.
+    '''
+    L = []
+    for f in [m.__primary_key__] + m.__fields__:
+        field = m.__mappings__[f]
+        if field.primary_key:
+            L.append('`%s` %s not null primary key' % (f, field.col_type))
+        else:
+            L.append('`%s` %s%s' % (f, field.col_type, '' if field.default is None else ' not null'))
+    for index in m.__indexes__.values():
+        L.append(str(index))
+    return 'create table `%s` (\n    %s\n) engine=innodb default charset=utf8;' % (m.__table__, ',\n    '.join(L))
+
+
+async def diff_model(db, m, drop=False):
+    L = []
+    table = m.__table__
+    columns = await live_columns(db, table)
+    for f, field in m.__mappings__.items():
+        if f not in columns:
+            L.append('alter table `%s` add column `%s` %s;' % (table, f, field.col_type))
+    indexes = await live_indexes(db, table)
+    for name, index in m.__indexes__.items():
+        live = indexes.get(name)
+        if live is None:
+            L.append('alter table `%s` add %s;' % (table, index))
+        elif live != index:
+            L.append('alter table `%s` drop index `%s`, add %s;' % (table, name, index))
+    for name, index in indexes.items():
+        if name not in m.__indexes__:
+            ddl = 'alter table `%s` drop index `%s`;' % (table, name)
+            L.append(ddl if drop else '-- not declared: %s (%s)' % (index, ddl))
+    return L
+
+
+async def migrate(loop, drop=False):
+    await myorm.create_pool(loop, **configs.database)
+    try:
+        db = configs.database.db
+        tables = await live_tables(db)
+        print('-- migration for database `%s`' % db)
+        for m in find_models(model):
+            if m.__table__ not in tables:
+                # 不能执行init.sql，其中的drop database会删除所有数据
+                print('\n-- %s' % m.__name__)
+                print(create_table(m))
+                continue
+            L = await diff_model(db, m, drop)
+            if L:
+                print('\n-- %s' % m.__name__)
+                print('\n'.join(L))
+    finally:
+        await myorm.close_pool()
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(migrate(loop, '--drop' in sys.argv[1:]))
+    loop.close()
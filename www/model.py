@@ -4,7 +4,7 @@
 import time
 import uuid
 
-from myorm import Model, StringField, BoolField, FloatField, TextField, IntField
+from myorm import Model, Index, StringField, BoolField, FloatField, TextField, IntField
 
 
 def next_id():
@@ -14,16 +14,19 @@ def next_id():
 class User(Model):
     __table__ = 'user'
     id = StringField(primary_key=True, default=next_id, col_type='varchar(50)')
-    email = StringField(col_type='varchar(50)')
+    email = StringField(col_type='varchar(50)', unique=True)
     password = StringField(col_type='varchar(50)')
     admin = BoolField()
     name = StringField(col_type='varchar(50)')
     image = StringField(col_type='varchar(500)')
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 
 class Blog(Model):
     __table__ = 'blog'
+    __cache__ = True
+    # 分类页面按cat_id过滤并按created_at排序
+    __indexes__ = [Index('cat_id', 'created_at')]
     id = StringField(primary_key=True, default=next_id, col_type='varchar(50)')
     user_id = StringField(col_type='varchar(50)')
     user_name = StringField(col_type='varchar(50)')
@@ -33,23 +36,32 @@ class Blog(Model):
     view_count = IntField()
     title = StringField(col_type='varchar(50)')
     summary = StringField(col_type='varchar(200)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(deferred=True)
+    created_at = FloatField(default=time.time, index=True)
 
 
 class Comment(Model):
     __table__ = 'comment'
+    # 博客页面按blog_id查询评论并按created_at排序
+    __indexes__ = [Index('blog_id', 'created_at')]
     id = StringField(primary_key=True, default=next_id, col_type='varchar(50)')
     blog_id = StringField(col_type='varchar(50)')
     user_id = StringField(col_type='varchar(50)')
     user_name = StringField(col_type='varchar(50)')
     user_image = StringField(col_type='varchar(500)')
     content = TextField()
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 
 class Category(Model):
     __table__ = 'category'
+    __cache__ = True
     id = StringField(primary_key=True, default=next_id, col_type='varchar(50)')
-    name = StringField(col_type='varchar(50)')
-    created_at = FloatField(default=time.time)
+    name = StringField(col_type='varchar(50)', unique=True)
+    created_at = FloatField(default=time.time, index=True)
+
+
+class Counter(Model):
+    __table__ = 'counters'
+    name = StringField(primary_key=True, col_type='varchar(100)')
+    value = IntField(col_type='bigint')
@@ -1,58 +1,436 @@
 #!/usr/bin/env python3
 # coding:utf-8
 
+import asyncio
+import contextlib
+import contextvars
 import logging
+import re
+import time
+from collections import OrderedDict
 
 import aiomysql
 
 logging.basicConfig(level=logging.INFO)
 
+__pool = None
+__replicas = []
+__balance = 'round_robin'
+__next_replica = 0
+_batch_find = False
+_profiler = None
+_loaders = dict()
+_query_cache = None
+
+# save_many/update_many/remove_many每条语句处理的最大记录数
+BATCH_SIZE = 500
+
 
 def logSQL(sql, arg=()):
-    logging.info('SQL: %s (arg: %s)' % (sql, arg))
+    # 参数延迟格式化，未开启DEBUG日志时几乎没有开销
+    logging.debug('SQL: %s (arg: %s)', sql, arg)
 
 
-async def create_pool(loop, **kw):
-    logging.info('create database connection pool...')
-    global __pool
-    __pool = await aiomysql.create_pool(
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', 3306),
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['db'],
-        charset=kw.get('charset', 'utf8'),
-        autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
+def set_profiler(profiler):
+    '''
+    Install a profiler (see sqlprofiler.SQLProfiler) called after each select() and execute()
+    with the timings, set_profiler(None) disables it. Sampling is up to the profiler.
+    '''
+    global _profiler
+    _profiler = profiler
+
+
+async def _create_pool(loop, kw, default=None):
+    default = default or dict()
+    def get(key, value=None):
+        return kw.get(key, default.get(key, value))
+    return await aiomysql.create_pool(
+        host=get('host', 'localhost'),
+        port=get('port', 3306),
+        user=get('user'),
+        password=get('password'),
+        db=get('db'),
+        charset=get('charset', 'utf8'),
+        autocommit=get('autocommit', True),
+        maxsize=get('maxsize', 10),
+        minsize=get('minsize', 1),
         loop=loop
     )
 
 
+async def create_pool(loop, **kw):
+    '''
+    Create the primary pool, and a pool for each item of kw['replicas'] if given.
+    Options missing in a replica config are taken from the primary config.
+    select() is routed to replicas by kw['balance'] ('round_robin' or 'least_busy'),
+    execute() always uses the primary.
+    '''
+    logging.info('create database connection pool...')
+    global __pool, __replicas, __balance, __next_replica
+    __pool = await _create_pool(loop, kw)
+    __replicas = []
+    for r in kw.get('replicas', None) or []:
+        logging.info('create replica connection pool: %s:%s' % (r.get('host', kw.get('host')), r.get('port', kw.get('port'))))
+        __replicas.append(await _create_pool(loop, r, kw))
+    __balance = kw.get('balance', 'round_robin')
+    if __balance not in ('round_robin', 'least_busy'):
+        raise ValueError('Invalid balance value: %s' % __balance)
+    __next_replica = 0
+    enable_batch_find(kw.get('batch_find', False))
+    # 有从库时，写入后replica_max_lag秒内读到的结果不缓存
+    enable_query_cache(kw.get('query_cache_size', 0), kw.get('query_cache_ttl', None),
+                       kw.get('replica_max_lag', 1) if __replicas else 0)
+
+
 async def close_pool():
     logging.info('close database connection pool...')
     global __pool
-    __pool.close()
-    await __pool.wait_closed()
+    for pool in [__pool] + __replicas:
+        pool.close()
+        await pool.wait_closed()
+
+
+# 当前请求(task)内是否执行过写操作，写过后的读操作使用主库，保证读到自己的写入
+_wrote = contextvars.ContextVar('myorm_wrote', default=False)
+
+
+def use_primary(flag=True):
+    '''
+    Route the following select() in current task to the primary database,
+    use_primary(False) resets it at the beginning of a request.
+    '''
+    _wrote.set(flag)
+
+
+def _read_pool():
+    global __next_replica
+    if not __replicas or _wrote.get():
+        return __pool
+    if __balance == 'least_busy':
+        return min(__replicas, key=lambda p: p.size - p.freesize)
+    __next_replica = (__next_replica + 1) % len(__replicas)
+    return __replicas[__next_replica]
+
+
+_RE_READ_TABLES = re.compile(r'\b(?:from|join)\s+`?(\w+)`?', re.IGNORECASE)
+_RE_WRITE_TABLE = re.compile(r'\s*(?:insert\s+(?:ignore\s+)?into|replace\s+into|update|delete\s+from)\s+`?(\w+)`?', re.IGNORECASE)
+
+
+class QueryCache(object):
+    '''
+    Cache select() results keyed by normalized sql and args, each entry records the tables
+    it depends on, any execute() on a table evicts the entries of the table. The total size
+    of rows is bounded by max_bytes (estimated), least recently used entries are evicted first.
+
+    Each table has a version bumped by evict(), a result read while one of its tables was
+    written is not stored, neither is a result read within settle seconds after a write
+    (replicas may still lag behind). Entries expire ttl seconds after set.
+    '''
+
+    def __init__(self, max_bytes, ttl=None, settle=0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.settle = settle
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._tables = dict()
+        # 表名 => (版本号, 最后写入时间)
+        self._versions = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(sql, args, size):
+        return ' '.join(sql.split()), tuple(args or ()), size
+
+    @staticmethod
+    def tables(sql):
+        return frozenset(t.lower() for t in _RE_READ_TABLES.findall(sql))
+
+    def versions(self, tables):
+        '''
+        Versions of tables, record before the select and pass to set().
+        '''
+        return tuple(self._versions.get(t, (0, 0))[0] for t in sorted(tables))
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or (entry[3] is not None and entry[3] < time.time()):
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, tables, versions, rs):
+        # 查询期间表被写过，结果可能是旧数据
+        if self.versions(tables) != versions:
+            return
+        now = time.time()
+        if self.settle and any(now - self._versions.get(t, (0, 0))[1] < self.settle for t in tables):
+            return
+        # 粗略估计结果集占用的内存
+        nbytes = 100 + sum(60 + sum(len(v) if isinstance(v, (str, bytes)) else 8 for v in r.values()) for r in rs)
+        if nbytes > self.max_bytes // 4:
+            return
+        self._remove(key)
+        self._data[key] = (rs, tables, nbytes, now + self.ttl if self.ttl else None)
+        self.bytes += nbytes
+        for t in tables:
+            self._tables.setdefault(t, set()).add(key)
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry[2]
+        for t in entry[1]:
+            keys = self._tables.get(t)
+            if keys is not None:
+                keys.discard(key)
+
+    def evict(self, table):
+        table = table.lower()
+        self._versions[table] = (self._versions.get(table, (0, 0))[0] + 1, time.time())
+        for key in self._tables.pop(table, ()):
+            self._remove(key)
+
+    def clear(self):
+        self._data.clear()
+        self._tables.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return dict(entries=len(self._data), bytes=self.bytes, hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+def enable_query_cache(max_bytes, ttl=None, settle=0):
+    '''
+    Enable the result cache of select(cache=True) with max_bytes memory, 0 disables it.
+    Models opt in by __cache__ = True, see QueryCache for ttl and settle.
+    '''
+    global _query_cache
+    _query_cache = QueryCache(max_bytes, ttl, settle) if max_bytes else None
+
+
+def query_cache_stats():
+    return _query_cache.stats() if _query_cache is not None else None
 
 
-async def select(sql, args, size=None):
+def _invalidate(sql):
+    '''
+    Evict the cached results of the table written by sql, called after the statement
+    finished. In transaction() the eviction is delayed until commit.
+    '''
+    if _query_cache is None:
+        return
+    m = _RE_WRITE_TABLE.match(sql)
+    if m:
+        tables = _tx_tables.get()
+        if tables is not None:
+            tables.add(m.group(1))
+        else:
+            _query_cache.evict(m.group(1))
+
+
+# connection()/transaction()内固定使用的连接: (conn, readonly)，以及是否处于事务中
+_pinned = contextvars.ContextVar('myorm_pinned', default=None)
+_in_transaction = contextvars.ContextVar('myorm_in_transaction', default=False)
+_tx_tables = contextvars.ContextVar('myorm_tx_tables', default=None)
+_tx_callbacks = contextvars.ContextVar('myorm_tx_callbacks', default=None)
+
+
+def on_commit(fn):
+    '''
+    Call fn() after the current transaction() commits, immediately if not in a transaction.
+    Callbacks are dropped when the transaction rolls back.
+    '''
+    callbacks = _tx_callbacks.get()
+    if callbacks is None:
+        fn()
+    else:
+        callbacks.append(fn)
+
+
+@contextlib.asynccontextmanager
+async def _acquire(write=False):
+    pinned = _pinned.get()
+    # 只读连接不执行写操作，写过之后也不再从只读连接读取
+    if pinned is not None and not (pinned[1] and (write or _wrote.get())):
+        yield pinned[0]
+    else:
+        async with (__pool if write else _read_pool()).get() as conn:
+            yield conn
+
+
+@contextlib.asynccontextmanager
+async def connection(readonly=False):
+    '''
+    Pin one connection for all select() and execute() in the block:
+
+        async with myorm.connection():
+            blog = await Blog.find(id)
+            comments = await Comment.findAll(where='blog_id=?', args=[id])
+
+    readonly=True takes the connection from the read pool, execute() in the block
+    still uses the primary. Nested blocks reuse the outer connection.
+    '''
+    if _pinned.get() is not None:
+        yield _pinned.get()[0]
+        return
+    async with (_read_pool() if readonly else __pool).get() as conn:
+        token = _pinned.set((conn, readonly))
+        try:
+            yield conn
+        finally:
+            _pinned.reset(token)
+
+
+@contextlib.asynccontextmanager
+async def transaction():
+    '''
+    Run all statements in the block on one primary connection in one transaction,
+    commit when the block exits normally, otherwise rollback:
+
+        async with myorm.transaction():
+            await blog.remove()
+            await Comment.remove_many(comments)
+
+    Nested transaction() joins the outer transaction.
+    '''
+    if _in_transaction.get():
+        yield _pinned.get()[0]
+        return
+    pinned = _pinned.get()
+    if pinned is not None and pinned[1]:
+        raise RuntimeError('Can not start transaction inside readonly connection.')
+    async with connection() as conn:
+        _wrote.set(True)
+        await conn.begin()
+        token = _in_transaction.set(True)
+        tables = set()
+        tables_token = _tx_tables.set(tables)
+        callbacks = []
+        callbacks_token = _tx_callbacks.set(callbacks)
+        committed = False
+        try:
+            yield conn
+        except BaseException:
+            await conn.rollback()
+            raise
+        else:
+            await conn.commit()
+            committed = True
+        finally:
+            _in_transaction.reset(token)
+            _tx_tables.reset(tables_token)
+            _tx_callbacks.reset(callbacks_token)
+            if _query_cache is not None:
+                for t in tables:
+                    _query_cache.evict(t)
+        if committed:
+            for fn in callbacks:
+                fn()
+
+
+async def select(sql, args, size=None, cache=False, primary=False):
+    '''
+    cache=True uses the query cache if enabled, except in a writable connection() or
+    transaction(), or after a write in current task. primary=True reads from the primary
+    database even in a readonly connection(), and does not use the query cache.
+    '''
     logSQL(sql, args)
-    global __pool
-    async with __pool.get() as conn:
+    pinned = _pinned.get()
+    # 只读连接内的读取同样可以使用缓存
+    if cache and not primary and _query_cache is not None and (pinned is None or pinned[1]) and not _wrote.get():
+        key = _query_cache.key(sql, args, size)
+        rs = _query_cache.get(key)
+        if rs is not None:
+            return rs
+        tables = _query_cache.tables(sql)
+        versions = _query_cache.versions(tables)
+        rs = await select(sql, args, size)
+        _query_cache.set(key, tables, versions, rs)
+        return rs
+    # 每条语句都计时，慢查询不受采样影响
+    profiler = _profiler
+    if profiler is not None:
+        start = time.perf_counter()
+    async with _acquire(write=primary) as conn:
+        if profiler is not None:
+            acquired = time.perf_counter()
         async with conn.cursor(aiomysql.DictCursor) as cur:
             await cur.execute(sql.replace('?', '%s'), args or ())
             if size:
                 rs = await cur.fetchmany(size)
             else:
                 rs = await cur.fetchall()
-        logging.info('rows returned: %s' % len(rs))
+        if profiler is not None:
+            await profiler.record(conn, sql, args, acquired - start, time.perf_counter() - acquired, len(rs))
+        logging.debug('rows returned: %s', len(rs))
         return rs
 
 
-async def execute(sql, args, autocommit=True):
+@contextlib.asynccontextmanager
+async def aclosing(agen):
+    '''
+    Close the async generator when the block exits, same as contextlib.aclosing() of
+    Python 3.10, use it when the loop over iterselect() or iter_all() may break early.
+    '''
+    try:
+        yield agen
+    finally:
+        await agen.aclose()
+
+
+async def iterselect(sql, args, batch=500):
+    '''
+    Async generator of rows using unbuffered server side cursor, fetch batch rows each time.
+    Always uses its own connection, because the pinned connection can not run other
+    statements before all rows are read.
+
+    The connection returns to the pool only when the generator finishes or is closed,
+    a loop which may break early must close it by aclosing():
+
+        async with myorm.aclosing(myorm.iterselect(sql, args)) as rows:
+            async for r in rows:
+                if ...:
+                    break
+    '''
+    logSQL(sql, args)
+    async with _read_pool().get() as conn:
+        async with conn.cursor(aiomysql.SSDictCursor) as cur:
+            await cur.execute(sql.replace('?', '%s'), args or ())
+            while True:
+                rs = await cur.fetchmany(batch)
+                if not rs:
+                    break
+                for r in rs:
+                    yield r
+
+
+async def execute(sql, args, autocommit=True, invalidate=True):
+    '''
+    invalidate=False keeps the cached results of the written table, for writes which
+    readers may see late, such as buffered view counts.
+    '''
     logSQL(sql, args)
-    async with __pool.get() as conn:
+    _wrote.set(True)
+    # 已在transaction()中时由外层事务提交或回滚
+    autocommit = autocommit or _in_transaction.get()
+    # 每条语句都计时，慢查询不受采样影响
+    profiler = _profiler
+    if profiler is not None:
+        start = time.perf_counter()
+    async with _acquire(write=True) as conn:
+        if profiler is not None:
+            acquired = time.perf_counter()
         if not autocommit:
             await conn.begin()
         try:
@@ -65,9 +443,45 @@ async def execute(sql, args, autocommit=True):
             if not autocommit:
                 await conn.rollback()
             raise
+        # 语句完成后再清除缓存，执行期间其他请求缓存的旧数据也被清除
+        if invalidate:
+            _invalidate(sql)
+        if profiler is not None:
+            await profiler.record(conn, sql, args, acquired - start, time.perf_counter() - acquired, rows)
         return rows
 
 
+async def executemany(statements):
+    '''
+    Execute statements in one transaction, statements is a list of (sql, seq_of_args).
+    Return the total affected rows.
+    '''
+    rows = 0
+    async with transaction() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            for sql, seq_args in statements:
+                logSQL(sql, '%s batch(es)' % len(seq_args))
+                await cur.executemany(sql.replace('?', '%s'), seq_args)
+                rows += cur.rowcount
+                _invalidate(sql)
+    return rows
+
+
+def normalize_key(key):
+    '''
+    Comparable form of a primary key as MySQL matches it with a case insensitive collation.
+
+    >>> normalize_key('AbC  ') == normalize_key('abc') and normalize_key(5) == normalize_key('5')
+    True
+    '''
+    return str(key).rstrip(' ').lower()
+
+
+def chunks(L, size):
+    for i in range(0, len(L), size):
+        yield L[i:i + size]
+
+
 def create_args_string(num):
     L = []
     for n in range(num):
@@ -75,13 +489,120 @@ def create_args_string(num):
     return ', '.join(L)
 
 
+class Loader(object):
+    '''
+    Collect find() of one model made in the same event loop tick, load them with one
+    "where pk in (...)" query and fan the objects out to the callers, duplicate keys
+    are loaded once. Keys of __cache__ models are looked up in the query cache first. A Loader can be created for one request, or use the global
+    loaders via enable_batch_find(True), then Model.find() is batched.
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        self._pending = dict()
+        self.calls = 0
+        self.batches = 0
+        self.keys = 0
+        self.max_batch = 0
+
+    def load(self, primary_key):
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        self.calls += 1
+        if not self._pending:
+            # 在空上下文中发起查询，不使用调用者固定的连接
+            loop.call_soon(self._dispatch, context=contextvars.Context())
+        self._pending.setdefault(primary_key, []).append(fut)
+        return fut
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, dict()
+        asyncio.get_event_loop().create_task(self._load(pending))
+
+    async def _load(self, pending):
+        model = self.model
+        keys = list(pending.keys())
+        self.batches += 1
+        self.keys += len(keys)
+        self.max_batch = max(self.max_batch, len(keys))
+        rows = dict()
+        cache = _query_cache if model.__cache__ else None
+        if cache is not None:
+            # 与find()的单行查询共用缓存项
+            tables = cache.tables(model.__find__)
+            versions = cache.versions(tables)
+            for key in keys:
+                rs = cache.get(cache.key(model.__find__, [key], 1))
+                if rs is not None:
+                    rows[key] = rs[0] if rs else None
+            missing = [key for key in keys if key not in rows]
+        else:
+            missing = keys
+        # 查询返回的行，按数据库中的主键值
+        loaded = dict()
+        try:
+            for chunk in chunks(missing, BATCH_SIZE):
+                sql = '%s where `%s` in (%s)' % (model.__select_all__, model.__primary_key__, create_args_string(len(chunk)))
+                for r in await select(sql, chunk):
+                    loaded[r[model.__primary_key__]] = r
+        except Exception as e:
+            for futs in pending.values():
+                for fut in futs:
+                    if not fut.done():
+                        fut.set_exception(e)
+            return
+        normalized = None
+        for key in missing:
+            r = loaded.get(key)
+            if r is None and loaded:
+                # MySQL按排序规则比较，大小写、尾部空格或类型不同的主键也能查到行
+                if normalized is None:
+                    normalized = {normalize_key(k): r for k, r in loaded.items()}
+                r = normalized.get(normalize_key(key))
+            rows[key] = r
+            if cache is not None:
+                cache.set(cache.key(model.__find__, [key], 1), tables, versions, [] if r is None else [r])
+        for key, futs in pending.items():
+            r = rows[key]
+            for fut in futs:
+                # 每个调用者得到独立的对象
+                if not fut.done():
+                    fut.set_result(None if r is None else model(**r))
+
+    def stats(self):
+        return dict(calls=self.calls, batches=self.batches, keys=self.keys, max_batch=self.max_batch,
+                    avg_batch=self.keys / self.batches if self.batches else 0)
+
+
+def enable_batch_find(flag=True):
+    global _batch_find
+    _batch_find = flag
+
+
+def loader(model):
+    'global Loader of model'
+    ld = _loaders.get(model)
+    if ld is None:
+        ld = _loaders[model] = Loader(model)
+    return ld
+
+
+def loader_stats():
+    return {model.__name__: ld.stats() for model, ld in _loaders.items()}
+
+
 class Field(object):
 
-    def __init__(self, name, col_type, primary_key, default):
+    def __init__(self, name, col_type, primary_key, default, deferred=False, index=False, unique=False):
         self.name = name
         self.col_type = col_type
         self.primary_key = primary_key
         self.default = default
+        # 延迟加载的字段不出现在列表查询中，需要时调用Model.load()
+        self.deferred = deferred
+        # 为该字段建立单列索引，unique=True时建立唯一索引
+        self.index = index or unique
+        self.unique = unique
 
     def __str__(self):
         return '<%s, %s: %s>' % (self.__class__.__name__, self.col_type, self.name)
@@ -89,32 +610,91 @@ class Field(object):
 
 class StringField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=None, col_type='varchar(100)'):
-        super().__init__(name, col_type, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, col_type='varchar(100)', deferred=False, index=False, unique=False):
+        super().__init__(name, col_type, primary_key, default, deferred, index, unique)
 
 
 class BoolField(Field):
 
-    def __init__(self, name=None, default=False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, 'boolean', False, default, index=index)
 
 
 class IntField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0, col_type='int'):
-        super().__init__(name, col_type, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, col_type='int', index=False, unique=False):
+        super().__init__(name, col_type, primary_key, default, index=index, unique=unique)
 
 
 class FloatField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False, unique=False):
+        super().__init__(name, 'real', primary_key, default, index=index, unique=unique)
 
 
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    def __init__(self, name=None, default=None, deferred=False):
+        super().__init__(name, 'text', False, default, deferred)
+
+
+class Row(object):
+    '''
+    Base class of compact rows generated by ModelMetaclass, a row keeps the values of
+    one record in __slots__ instead of a dict, use Model.findAll(compact=True) to get rows.
+    '''
+    __slots__ = ()
+
+    def __init__(self, **kw):
+        for k, v in kw.items():
+            setattr(self, k, v)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def _asdict(self):
+        d = dict()
+        for k in self.__slots__:
+            try:
+                d[k] = getattr(self, k)
+            except AttributeError:
+                # 只查询了部分列时，未赋值的字段不输出
+                pass
+        return d
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % kv for kv in self._asdict().items()))
+
+
+def create_row_class(name, fields):
+    return type(name + 'Row', (Row,), dict(__slots__=tuple(fields)))
+
+
+class Index(object):
+    '''
+    Index on one or more columns, declare in model by __indexes__:
+
+        __indexes__ = [Index('cat_id', 'created_at')]
+
+    single column index can be declared by Field(index=True) or Field(unique=True).
+    '''
+
+    def __init__(self, *columns, name=None, unique=False):
+        self.columns = tuple(columns)
+        self.name = name or 'idx_' + '_'.join(columns)
+        self.unique = unique
+
+    def __eq__(self, other):
+        return isinstance(other, Index) and (self.columns, self.unique) == (other.columns, other.unique)
+
+    def __str__(self):
+        return '%skey `%s` (%s)' % ('unique ' if self.unique else '', self.name, ', '.join('`%s`' % c for c in self.columns))
 
 
 class ModelMetaclass(type):
@@ -149,31 +729,80 @@ class ModelMetaclass(type):
             attrs.pop(k)
         escaped_fields = list(map(lambda f: '`%s`' % f, fields))
         attrs['__mappings__'] = mappings    # 单独保存属性和列的映射关系
+        attrs['__cache__'] = attrs.get('__cache__', False)  # 是否使用查询结果缓存
         attrs['__table__'] = tableName
         attrs['__primary_key__'] = primaryKey
         attrs['__fields__'] = fields
         # 构造默认的SELECT, INSERT, UPDATE和DELETE语句
-        attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
+        deferred = [f for f in fields if mappings[f].deferred]
+        attrs['__deferred__'] = deferred
+        # __select__用于列表查询，不含延迟加载的字段；__select_all__用于按主键查询
+        attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(['`%s`' % f for f in fields if f not in deferred]), tableName)
+        attrs['__select_all__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
+        attrs['__find__'] = '%s where `%s`=?' % (attrs['__select_all__'], primaryKey)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
+        attrs['__update_sqls__'] = dict()   # 缓存按修改列生成的UPDATE语句
+        attrs['__row__'] = create_row_class(name, [primaryKey] + fields)    # findAll(compact=True)返回的行类型
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
+        # 索引声明在发起查询的模型旁，migrate.py据此生成DDL
+        indexes = [Index(f, unique=mappings[f].unique) for f in fields if mappings[f].index]
+        indexes.extend(attrs.get('__indexes__', []))
+        attrs['__indexes__'] = dict()
+        for index in indexes:
+            for c in index.columns:
+                if c not in mappings:
+                    raise Exception('Index %s on unknown field: %s' % (index.name, c))
+            if index.name in attrs['__indexes__']:
+                raise Exception('Duplicate index name: %s' % index.name)
+            attrs['__indexes__'][index.name] = index
         return type.__new__(cls, name, bases, attrs)
 
 
-class Model(dict, metaclass=ModelMetaclass):
+_MISSING = object()
 
-    def __init__(self, **kw):
-        super().__init__(**kw)
+
+class Model(dict, metaclass=ModelMetaclass):
 
     def __getattr__(self, key):
         try:
             return self[key]
         except KeyError:
+            if key in self.__deferred__:
+                raise AttributeError(r"Deferred field '%s' is not loaded, call load() first" % key)
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
         self[key] = value
 
+    def __setitem__(self, key, value):
+        if key in self.__mappings__ and self.get(key, _MISSING) != value:
+            # 记录自载入以来被修改过的字段，第一次修改时才创建集合，构造时传入的值视为已载入
+            dirty = self.__dict__.get('_dirty')
+            if dirty is None:
+                dirty = self.__dict__['_dirty'] = set()
+            dirty.add(key)
+        super().__setitem__(key, value)
+
+    def dirtyFields(self):
+        'modified fields since load, in the order of __fields__'
+        dirty = self.__dict__.get('_dirty')
+        if not dirty:
+            return ()
+        return tuple(f for f in self.__fields__ if f in dirty)
+
+    def _clean(self):
+        self.__dict__.pop('_dirty', None)
+
+    @classmethod
+    def getUpdateSQL(cls, fields):
+        'UPDATE statement which only sets the given fields, cached per field tuple'
+        sql = cls.__update_sqls__.get(fields)
+        if sql is None:
+            sql = 'update `%s` set %s where `%s`=?' % (cls.__table__, ', '.join(map(lambda f: '`%s`=?' % (cls.__mappings__.get(f).name or f), fields)), cls.__primary_key__)
+            cls.__update_sqls__[fields] = sql
+        return sql
+
     def getValue(self, key):
         return getattr(self, key, None)
 
@@ -188,19 +817,36 @@ class Model(dict, metaclass=ModelMetaclass):
         return value
 
     @classmethod
-    async def findAll(cls, col=None, where=None, args=None, **kw):
-        'find objects by where clause, return value is a list'
+    def buildSelect(cls, col=None, where=None, args=None, **kw):
+        '''
+        build select statement for findAll() and iter_all(), return (sql, args).
+        deferred fields are not selected unless undefer=True.
+        keyset pagination: after=(value, pk) or before=(value, pk) seeks by (seekKey, primary key)
+        in descending order instead of using an offset, seekKey defaults to 'created_at'.
+        '''
         if col is None:
-            sql = [cls.__select__]
+            sql = [cls.__select_all__ if kw.get('undefer', False) else cls.__select__]
         else:
             _select = 'select `%s` from `%s`' % ('`, `'.join(col), cls.__table__)
             sql = [_select]
-        if where:
-            sql.append('where')
-            sql.append(where)
         if args is None:
             args = []
         orderBy = kw.get('orderBy', None)
+        after = kw.get('after', None)
+        before = kw.get('before', None)
+        if after is not None or before is not None:
+            # 按(seekKey, 主键)定位，MySQL不必扫描并丢弃offset之前的行
+            key = kw.get('seekKey', 'created_at')
+            pk = cls.__primary_key__
+            op, order = ('<', 'desc') if after is not None else ('>', 'asc')
+            value, pk_value = after if after is not None else before
+            seek = '(`%s`%s? or (`%s`=? and `%s`%s?))' % (key, op, key, pk, op)
+            where = '(%s) and %s' % (where, seek) if where else seek
+            args = list(args) + [value, value, pk_value]
+            orderBy = '`%s` %s, `%s` %s' % (key, order, pk, order)
+        if where:
+            sql.append('where')
+            sql.append(where)
         if orderBy:
             sql.append('order by')
             sql.append(orderBy)
@@ -215,19 +861,50 @@ class Model(dict, metaclass=ModelMetaclass):
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        logging.info('sql: %s' % sql)
-        logging.info('args: %s' % args)
-        rs = await select(' '.join(sql), args)
+        return ' '.join(sql), args
+
+    @classmethod
+    async def findAll(cls, col=None, where=None, args=None, **kw):
+        '''
+        find objects by where clause, return value is a list, see buildSelect() for kw.
+        compact=True returns lightweight __row__ objects instead of model objects.
+        cache=False bypasses the query cache of __cache__ models.
+        '''
+        sql, args = cls.buildSelect(col, where, args, **kw)
+        rs = await select(sql, args, cache=cls.__cache__ and kw.get('cache', True))
+        if kw.get('before', None) is not None:
+            # 向前翻页时按升序查询，需反转为降序
+            rs = rs[::-1]
+        if kw.get('compact', False):
+            row = cls.__row__
+            return [row(**r) for r in rs]
         return [cls(**r) for r in rs]
 
     @classmethod
-    async def findNumber(cls, col, where=None, args=None):
-        'find number using "count" in col by where'
+    async def iter_all(cls, col=None, where=None, args=None, batch=500, **kw):
+        '''
+        async generator of objects by where clause, rows are streamed from server side
+        so at most batch rows are kept in memory. Use aclosing() so the connection is
+        released even if the loop breaks early:
+
+            async with aclosing(Blog.iter_all(where='cat_id=?', args=[cat_id])) as blogs:
+                async for blog in blogs:
+                    ...
+        '''
+        sql, args = cls.buildSelect(col, where, args, **kw)
+        make = cls.__row__ if kw.get('compact', False) else cls
+        async with aclosing(iterselect(sql, args, batch)) as rows:
+            async for r in rows:
+                yield make(**r)
+
+    @classmethod
+    async def findNumber(cls, col, where=None, args=None, cache=True):
+        'find number using "count" in col by where, cache=False bypasses the query cache'
         sql = ['select count(%s) _num_ from `%s`' % (col, cls.__table__)]
         if where:
             sql.append('where')
             sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+        rs = await select(' '.join(sql), args, 1, cache=cls.__cache__ and cache)
         if len(rs) == 0:
             return None
         return rs[0]['_num_']
@@ -235,24 +912,113 @@ class Model(dict, metaclass=ModelMetaclass):
     @classmethod
     async def find(cls, primary_key):
         'find object by primary key'
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [primary_key], 1)
+        # 固定连接、事务中或写过之后直接查询，保证读到自己的写入
+        if _batch_find and _pinned.get() is None and not _wrote.get():
+            return await loader(cls).load(primary_key)
+        rs = await select(cls.__find__, [primary_key], 1, cache=cls.__cache__)
         if len(rs) == 0:
             return None
         return cls(**rs[0])
 
+    @classmethod
+    async def save_many(cls, objs, batch=None):
+        'insert objects with multi-row VALUES statements in one transaction, return affected rows'
+        batch = batch or BATCH_SIZE
+        objs = list(objs)
+        statements = []
+        for chunk in chunks(objs, batch):
+            args = []
+            for obj in chunk:
+                args.extend(map(obj.getValueOrDefault, cls.__fields__))
+                args.append(obj.getValueOrDefault(cls.__primary_key__))
+            values = ', '.join(['(%s)' % create_args_string(len(cls.__fields__) + 1)] * len(chunk))
+            sql = cls.__insert__[:cls.__insert__.rindex('values')] + 'values ' + values
+            statements.append((sql, [args]))
+        if not statements:
+            return 0
+        rows = await executemany(statements)
+        for obj in objs:
+            obj._clean()
+        return rows
+
+    @classmethod
+    async def update_many(cls, objs, batch=None):
+        'update modified fields of objects in one transaction, return affected rows'
+        batch = batch or BATCH_SIZE
+        objs = list(objs)
+        # 按修改字段分组，每组使用同一条UPDATE语句
+        groups = dict()
+        for obj in objs:
+            fields = obj.dirtyFields()
+            if fields:
+                args = list(map(obj.getValue, fields))
+                args.append(obj.getValue(cls.__primary_key__))
+                groups.setdefault(fields, []).append(args)
+        statements = []
+        for fields, seq_args in groups.items():
+            sql = cls.getUpdateSQL(fields)
+            statements.extend((sql, chunk) for chunk in chunks(seq_args, batch))
+        if not statements:
+            return 0
+        rows = await executemany(statements)
+        for obj in objs:
+            obj._clean()
+        return rows
+
+    @classmethod
+    async def remove_many(cls, objs, batch=None):
+        'delete objects, compact rows or primary keys with "in" statements in one transaction, return affected rows'
+        batch = batch or BATCH_SIZE
+        pk = cls.__primary_key__
+        pks = [obj.get(pk) if isinstance(obj, (Model, Row)) else obj for obj in objs]
+        statements = []
+        for chunk in chunks(pks, batch):
+            sql = 'delete from `%s` where `%s` in (%s)' % (cls.__table__, cls.__primary_key__, create_args_string(len(chunk)))
+            statements.append((sql, [chunk]))
+        if not statements:
+            return 0
+        return await executemany(statements)
+
+    async def load(self, *fields):
+        '''
+        Load deferred fields (all deferred fields by default) which are not loaded yet:
+
+            blog = (await Blog.findAll(where='id=?', args=[id]))[0]
+            await blog.load()
+            blog.content
+        '''
+        fields = [f for f in (fields or self.__deferred__) if f not in self]
+        if not fields:
+            return self
+        sql = 'select `%s` from `%s` where `%s`=?' % ('`, `'.join(fields), self.__table__, self.__primary_key__)
+        rs = await select(sql, [self.getValue(self.__primary_key__)], 1)
+        if len(rs) == 0:
+            raise ValueError('Record not found: %s' % self.getValue(self.__primary_key__))
+        # 载入的值不算修改
+        for k, v in rs[0].items():
+            dict.__setitem__(self, k, v)
+        return self
+
     async def save(self):
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
         rows = await execute(self.__insert__, args)
         if rows != 1:
             logging.warn('Failed to insert record: affected rows:%s' % rows)
+        self._clean()
 
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        # 只更新被修改过的字段，没有修改则不访问数据库
+        fields = self.dirtyFields()
+        if not fields:
+            logging.debug('Nothing changed, skip update: %s' % self.getValue(self.__primary_key__))
+            return
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await execute(self.getUpdateSQL(fields), args)
         if rows != 1:
             logging.warn('Failed to update by primary key: affected rows: %s' % rows)
+        self._clean()
 
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+'''
+SQL profiler, install with myorm.set_profiler(SQLProfiler(...)).
+'''
+
+import logging
+import random
+import re
+
+import aiomysql
+
+logging.basicConfig(level=logging.INFO)
+
+slow_logger = logging.getLogger('slowquery')
+
+# 耗时直方图各桶的上限（毫秒），最后一个桶为无穷大
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+_RE_IN_ARGS = re.compile(r'\(\s*\?(\s*,\s*\?)*\s*\)')
+_RE_SPACES = re.compile(r'\s+')
+
+
+def shape(sql):
+    '''
+    Normalize sql to statement shape, so statements only differ in number of args are grouped.
+
+    >>> shape('select * from `blog` where `id` in (?, ?, ?)')
+    'select * from `blog` where `id` in (...)'
+    '''
+    return _RE_SPACES.sub(' ', _RE_IN_ARGS.sub('(...)', sql)).strip()
+
+
+class StatementStats(object):
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.wait = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, wait, elapsed, rows):
+        self.count += 1
+        self.total += elapsed
+        self.wait += wait
+        self.rows += rows
+        if elapsed > self.max:
+            self.max = elapsed
+        ms = elapsed * 1000
+        for i, limit in enumerate(BUCKETS):
+            if ms <= limit:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def todict(self):
+        return dict(shape=self.shape, count=self.count, total_ms=self.total * 1000,
+                    avg_ms=self.total * 1000 / self.count, max_ms=self.max * 1000,
+                    avg_wait_ms=self.wait * 1000 / self.count, rows=self.rows,
+                    histogram=dict(zip(['<=%sms' % b for b in BUCKETS] + ['>%sms' % BUCKETS[-1]], self.buckets)))
+
+
+class SQLProfiler(object):
+    '''
+    Record latency histogram, rows and pool wait time per statement shape for
+    sample_rate of all statements, log every statement slower than slow_ms milliseconds,
+    sampled or not, to the 'slowquery' logger, with EXPLAIN output if explain is True.
+    '''
+
+    def __init__(self, sample_rate=1.0, slow_ms=500, explain=False):
+        self.sample_rate = sample_rate
+        self.slow = slow_ms / 1000
+        self.explain = explain
+        self.stats = dict()
+
+    def sampled(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    async def record(self, conn, sql, args, wait, elapsed, rows):
+        '''
+        Called by myorm with the connection which ran the statement.
+        '''
+        if self.sampled():
+            key = shape(sql)
+            st = self.stats.get(key)
+            if st is None:
+                st = self.stats[key] = StatementStats(key)
+            st.add(wait, elapsed, rows)
+        if elapsed < self.slow:
+            return
+        plan = ''
+        if self.explain and sql.lstrip()[:6].lower() == 'select':
+            try:
+                async with conn.cursor(aiomysql.DictCursor) as cur:
+                    await cur.execute('explain ' + sql.replace('?', '%s'), args or ())
+                    plan = '\n'.join(str(r) for r in await cur.fetchall())
+            except Exception as e:
+                plan = 'explain failed: %s' % e
+        slow_logger.warning('%.1f ms (wait %.1f ms, rows %s): %s (arg: %s)%s' %
+                            (elapsed * 1000, wait * 1000, rows, sql, args, '\n' + plan if plan else ''))
+
+    def report(self, top=20):
+        '''
+        Statement stats ordered by total time.
+        '''
+        stats = sorted(self.stats.values(), key=lambda st: st.total, reverse=True)
+        return [st.todict() for st in stats[:top]]
+
+    def reset(self):
+        self.stats.clear()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+'''
+Jinja2 environment of the web app, usage: ./templating.py [target]
+
+Compile all templates of www/templates ahead of time to python modules in target,
+default www/templates-compiled, load them with create_env(compiled=target).
+'''
+
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, ModuleLoader, ChoiceLoader, nodes
+from jinja2.ext import Extension
+
+from cache import LRUCache
+from configloader import configs
+
+logging.basicConfig(level=logging.INFO)
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_PATH = os.path.join(BASE_PATH, 'templates')
+COMPILED_PATH = os.path.join(BASE_PATH, 'templates-compiled')
+BYTECODE_PATH = os.path.join(BASE_PATH, 'templates-bytecode')
+
+
+def deltatime_filter(t):
+    '''
+    jinja2自定义过滤器
+    '''
+    delta = int(time.time() - t)
+    if delta < 60:
+        return u'1分钟前'
+    if delta < 3600:
+        return u'%s分钟前' % (delta // 60)
+    if delta < 86400:
+        return u'%s小时前' % (delta // 3600)
+    if delta < 604800:
+        return u'%s天前' % (delta // 86400)
+    dt = datetime.fromtimestamp(t)
+    return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
+
+
+def date_filter(t):
+    '''
+    jinjia2自定义过滤器，以“年－月－日”格式显示日期
+    '''
+    dt = datetime.fromtimestamp(t)
+    return u'%s-%s-%s' % (dt.year, dt.month, dt.day)
+
+
+FILTERS = dict(deltatime=deltatime_filter, date=date_filter)
+
+
+class FragmentCache(object):
+    '''
+    Bounded cache of rendered template fragments. The fragment name is also its tag,
+    invalidate(name) drops all fragments of the name whatever their keys are, ttl covers
+    changes made outside the app.
+    '''
+
+    def __init__(self, maxsize=1000, ttl=None):
+        self._cache = LRUCache(maxsize, ttl)
+        self._versions = dict()
+        # 配置cache.render_in_executor时模板在线程池中渲染
+        self._lock = threading.Lock()
+
+    def fetch(self, name, key, render):
+        # 失效时递增版本号，旧版本的片段不再命中，由LRU淘汰
+        k = (name, self._versions.get(name, 0), key)
+        with self._lock:
+            value = self._cache.get(k)
+        if value is None:
+            value = render()
+            with self._lock:
+                self._cache.set(k, value)
+        return value
+
+    def invalidate(self, *names):
+        with self._lock:
+            for name in names:
+                self._versions[name] = self._versions.get(name, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+fragment_cache = FragmentCache(configs.cache.fragment_size, ttl=configs.cache.fragment_ttl)
+
+
+class FragmentCacheExtension(Extension):
+    '''
+    {% cache 'sidebar' %}...{% endcache %} or {% cache 'navbar', user.id %}...{% endcache %},
+    the first argument is the fragment name, the others are parts of the cache key.
+    '''
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache_support', [nodes.List(args)]), [], [], body).set_lineno(lineno)
+
+    def _cache_support(self, args, caller):
+        cache = self.environment.fragment_cache
+        if cache is None:
+            return caller()
+        return cache.fetch(args[0], tuple(args[1:]), caller)
+
+
+def create_env(path=TEMPLATE_PATH, production=False, bytecode_cache=BYTECODE_PATH, compiled=None, **kw):
+    '''
+    Development mode reloads changed templates. Production mode does not check template
+    files once loaded, and caches compiled bytecode in bytecode_cache directory across
+    restarts. Templates precompiled to compiled directory are used before the sources.
+    {% cache %} fragments are stored in fragment_cache, None to disable.
+    '''
+    loader = FileSystemLoader(path)
+    if compiled is not None and os.path.isdir(compiled):
+        # 预编译目录中没有的模板从源文件编译
+        loader = ChoiceLoader([ModuleLoader(compiled), loader])
+        logging.info('use precompiled templates: %s' % compiled)
+    options = dict(
+        autoescape=kw.get('autoescape', True),
+        auto_reload=not production
+    )
+    if production and bytecode_cache:
+        os.makedirs(bytecode_cache, exist_ok=True)
+        options['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache)
+    env = Environment(loader=loader, extensions=[FragmentCacheExtension], **options)
+    env.fragment_cache = kw.get('fragment_cache', fragment_cache)
+    env.filters.update(FILTERS)
+    filters = kw.get('filters', None)
+    if filters is not None:
+        env.filters.update(filters)
+    functions = kw.get('globals', None)
+    if functions is not None:
+        env.globals.update(functions)
+    return env
+
+
+def compile_all(path=TEMPLATE_PATH, target=COMPILED_PATH):
+    '''
+    Compile all templates in path to python modules in target directory.
+    '''
+    env = create_env(path)
+    env.compile_templates(target, zip=None, ignore_errors=False)
+    return env.list_templates()
+
+
+if __name__ == '__main__':
+    target = sys.argv[1] if len(sys.argv) > 1 else COMPILED_PATH
+    names = compile_all(target=target)
+    print('%s templates compiled to %s' % (len(names), target))
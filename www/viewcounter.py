@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+'''
+Write-behind counter, buffer increments in memory and flush them to database periodically.
+'''
+
+import asyncio
+import logging
+
+import myorm
+
+logging.basicConfig(level=logging.INFO)
+
+
+class ViewCounter(object):
+    '''
+    Buffer increments of a counter column per primary key, and flush all of them
+    with one UPDATE statement every interval seconds.
+
+    The flush does not evict cached query results of the table unless invalidate=True,
+    so cached rows show the counter up to query_cache_ttl seconds late.
+    '''
+
+    def __init__(self, table, column, primary_key='id', interval=5.0, invalidate=False):
+        self.table = table
+        self.column = column
+        self.primary_key = primary_key
+        self.interval = interval
+        self.invalidate = invalidate
+        self._pending = dict()
+        self._task = None
+
+    @property
+    def backlog(self):
+        '''
+        Number of keys waiting to be flushed.
+        '''
+        return len(self._pending)
+
+    def incr(self, key, n=1):
+        self._pending[key] = self._pending.get(key, 0) + n
+
+    def pending(self, key):
+        '''
+        Increments of key which are not written to database yet.
+        '''
+        return self._pending.get(key, 0)
+
+    def start(self, loop):
+        if self._task is None:
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.exception(e)
+
+    async def flush(self):
+        if not self._pending:
+            return 0
+        # 先交换缓冲区，flush过程中的新增计数进入新缓冲区
+        pending, self._pending = self._pending, dict()
+        cases = []
+        args = []
+        for key, n in pending.items():
+            cases.append('when ? then ?')
+            args.extend((key, n))
+        args.extend(pending.keys())
+        sql = 'update `%s` set `%s`=`%s`+(case `%s` %s end) where `%s` in (%s)' % \
+            (self.table, self.column, self.column, self.primary_key, ' '.join(cases),
+             self.primary_key, myorm.create_args_string(len(pending)))
+        try:
+            rows = await myorm.execute(sql, args, invalidate=self.invalidate)
+        except BaseException:
+            # 写入失败，将计数放回缓冲区等待下次flush
+            for key, n in pending.items():
+                self.incr(key, n)
+            raise
+        logging.info('flush %s: %s keys, affected rows: %s' % (self.table, len(pending), rows))
+        return rows
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
@@ -8,14 +8,18 @@ import logging
 import functools
 import json
 import time
+import base64
 import hashlib
 
 from aiohttp import web
-from urllib import parse
 
+import myorm
 from APIError import APIError
 from configloader import configs
 from model import User
+from cache import LRUCache, SingleFlight
+import compress
+import jsonutil
 
 logging.basicConfig(level=logging.INFO)
 
@@ -48,6 +52,19 @@ def post(path):
     return decorator
 
 
+def cache_page(on_hit=None):
+    '''
+    Define decorator @cache_page(), put it under @get('/path'), the page is cached for
+    anonymous visitors by page_cache_factory. Only 200 text/html responses are cached,
+    on_hit(request) is called when the page is served from cache.
+    '''
+    def decorator(func):
+        func.__page_cache__ = True
+        func.__page_cache_hit__ = on_hit
+        return func
+    return decorator
+
+
 def get_required_kw_args(fn):
     # 获取无缺省值的命名关键字参数
     args = []
@@ -112,41 +129,52 @@ class RequestHandler(object):
         self._has_named_kw_arg = has_named_kw_arg(fn)
         self._named_kw_args = get_named_kw_args(fn)
         self._required_kw_args = get_required_kw_args(fn)
+        # 在add_route时根据handler签名确定参数绑定方式，请求时不再重复判断
+        if self._has_var_kw_arg or self._has_named_kw_arg or self._required_kw_args:
+            self._bind = self._bind_params
+        else:
+            self._bind = self._bind_match_info
+        # 没有**kw参数时只保留命名关键字参数
+        self._keep_args = None if self._has_var_kw_arg else self._named_kw_args
+        self.page_cache = getattr(fn, '__page_cache__', False)
+        self.on_cache_hit = getattr(fn, '__page_cache_hit__', None)
+
+    async def _bind_match_info(self, request):
+        kw = dict(request.match_info)
+        if self._has_request_arg:
+            kw['request'] = request
+        return kw
 
-    async def __call__(self, request):
+    async def _bind_params(self, request):
         kw = None
-        if self._has_var_kw_arg or self._has_named_kw_arg or self._required_kw_args:
-            if request.method == 'POST':
-                if not request.content_type:
-                    return web.HTTPBadRequest('Missing Content-Type.')
-                ct = request.content_type.lower()
-                if ct.startswith('application/json'):
-                    params = await request.json()
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest('JSON body must be object.')
-                    kw = params
-                elif ct.startswith('application/x-www-form-urlencoded') or \
-                        ct.startswith('multipart/form-data'):
-                    params = await request.post()
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
-            if request.method == 'GET':
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
+        keep = self._keep_args
+        if request.method == 'POST':
+            if not request.content_type:
+                return web.HTTPBadRequest('Missing Content-Type.')
+            ct = request.content_type.lower()
+            if ct.startswith('application/json'):
+                params = await request.json()
+                if not isinstance(params, dict):
+                    return web.HTTPBadRequest('JSON body must be object.')
+            elif ct.startswith('application/x-www-form-urlencoded') or \
+                    ct.startswith('multipart/form-data'):
+                params = await request.post()
+            else:
+                return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
+            if keep is None:
+                kw = dict(**params)
+            else:
+                kw = {name: params[name] for name in keep if name in params}
+        elif request.method == 'GET':
+            # request.query由aiohttp解析并缓存，同名参数取第一个值
+            query = request.query
+            if keep is None:
+                kw = {k: query[k] for k in query.keys()}
+            else:
+                kw = {name: query[name] for name in keep if name in query}
         if kw is None:
-            kw = dict(**request.match_info)
+            kw = dict(request.match_info)
         else:
-            if not self._has_var_kw_arg and self._named_kw_args:
-                # remove all unnamed kw
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
             # check named arg
             for k, v in request.match_info.items():
                 if k in kw:
@@ -155,11 +183,16 @@ class RequestHandler(object):
         if self._has_request_arg:
             kw['request'] = request
         # check required kw
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if name not in kw:
-                    return web.HTTPBadRequest('Missing argument: %s' % name)
-        logging.info('call with args: %s' % str(kw))
+        for name in self._required_kw_args:
+            if name not in kw:
+                return web.HTTPBadRequest('Missing argument: %s' % name)
+        return kw
+
+    async def __call__(self, request):
+        kw = await self._bind(request)
+        if not isinstance(kw, dict):
+            return kw
+        logging.debug('call with args: %s', kw)
 
         try:
             r = await self._func(**kw)
@@ -174,6 +207,28 @@ def add_static(app):
     logging.info('add static %s => %s' % ('/static/', path))
 
 
+def add_assets(app, assets):
+    '''
+    Serve fingerprinted files of assets.Assets from memory, with precompressed variants.
+    '''
+    async def asset_handler(request):
+        item = assets.get(request.match_info['path'])
+        if item is None:
+            raise web.HTTPNotFound()
+        content_type, variants = item
+        # 文件名包含内容哈希，内容不会改变
+        headers = {'Content-Type': content_type, 'Cache-Control': 'public, max-age=31536000, immutable'}
+        encoding = None
+        if len(variants) > 1:
+            headers['Vary'] = 'Accept-Encoding'
+            encoding = compress.negotiate(request.headers.get('Accept-Encoding'), [e for e in compress.ENCODINGS if e in variants])
+            if encoding is not None:
+                headers['Content-Encoding'] = encoding
+        return web.Response(body=variants[encoding], headers=headers)
+    app.router.add_route('GET', assets.prefix + '{path:.+}', asset_handler)
+    logging.info('add assets %s => %s files' % (assets.prefix, len(assets.files)))
+
+
 def add_route(app, fn):
     method = getattr(fn, '__method__', None)
     path = getattr(fn, '__route__', None)
@@ -209,10 +264,129 @@ def add_routes(app, module_name):
 async def logger_factory(app, handler):
     async def logger_middleware(request):
         logging.info('Request: %s %s' % (request.method, request.path))
+        # keep-alive连接的多个请求可能在同一task内处理，每个请求开始时重置读写分离状态
+        myorm.use_primary(False)
         return await handler(request)
     return logger_middleware
 
 
+# 配置cache.render_in_executor时在线程池中渲染，并合并并发的相同渲染，
+# handler通过返回dict中的'__render_key__'启用；默认在事件循环中直接渲染
+render_flight = SingleFlight(timeout=configs.cache.single_flight_timeout)
+
+
+def render(app, template, r):
+    return app['__template_env__'].get_template(template).render(**r).encode('utf-8')
+
+
+# 匿名访问的整页缓存: (path_qs, 压缩编码) => (body, headers)，同一页面的各压缩版本分别缓存
+page_cache = LRUCache(configs.cache.page_size, ttl=configs.cache.page_ttl)
+_page_version = 0
+
+
+def invalidate_pages():
+    '''
+    Must be called after blogs, comments or categories are changed.
+    '''
+    global _page_version
+    _page_version += 1
+    page_cache.clear()
+
+
+def page_version():
+    '''
+    Changed by invalidate_pages(), part of single-flight keys so a request after a write
+    does not join a load or render of the data before it.
+    '''
+    return _page_version
+
+
+def etag_matched(request, etag):
+    inm = request.headers.get('If-None-Match')
+    if not inm:
+        return False
+    tags = [t.strip() for t in inm.split(',')]
+    return etag in tags or '*' in tags
+
+
+async def page_cache_factory(app, handler):
+    async def page_cache_middleware(request):
+        route_handler = request.match_info.route.handler
+        if request.method != 'GET' or not getattr(route_handler, 'page_cache', False) or \
+                request.cookies.get(configs.cookie.name):
+            return await handler(request)
+        key = (request.path_qs, accepted_encoding(request))
+        entry = page_cache.get(key)
+        if entry is None:
+            version = _page_version
+            resp = await handler(request)
+            # 只缓存渲染出的页面，APIError转成的JSON错误结果不缓存，命中时也不会为不存在的id计数
+            if not isinstance(resp, web.Response) or resp.status != 200 or resp.content_type != 'text/html' or \
+                    resp.cookies or not isinstance(resp.body, bytes):
+                return resp
+            headers = dict(ETag='"%s"' % hashlib.sha1(resp.body).hexdigest())
+            for name in ('Content-Type', 'Content-Encoding', 'Vary'):
+                if name in resp.headers:
+                    headers[name] = resp.headers[name]
+            entry = (resp.body, headers)
+            # 生成期间页面被invalidate的结果不缓存
+            if version == _page_version:
+                page_cache.set(key, entry)
+        elif route_handler.on_cache_hit is not None:
+            route_handler.on_cache_hit(request)
+        body, headers = entry
+        if etag_matched(request, headers['ETag']):
+            return web.Response(status=304, headers={k: v for k, v in headers.items() if k in ('ETag', 'Vary')})
+        return web.Response(body=body, headers=headers)
+    return page_cache_middleware
+
+
+compress_levels = dict(gzip=configs.compress.gzip_level, br=configs.compress.brotli_quality)
+
+
+def accepted_encoding(request):
+    if not configs.compress.enable:
+        return None
+    return compress.negotiate(request.headers.get('Accept-Encoding'))
+
+
+def add_vary(headers, name):
+    '''
+    Add name to the Vary header, keeping the names set by handlers.
+    '''
+    vary = headers.get('Vary')
+    if not vary:
+        headers['Vary'] = name
+    elif vary.strip() != '*' and name.lower() not in (v.strip().lower() for v in vary.split(',')):
+        headers['Vary'] = '%s, %s' % (vary, name)
+
+
+async def compress_factory(app, handler):
+    async def compress_middleware(request):
+        resp = await handler(request)
+        # 流式响应(如大的JSON列表)由aiohttp自行压缩
+        if not isinstance(resp, web.Response) or resp.status != 200 or not configs.compress.enable or \
+                'Content-Encoding' in resp.headers or not compress.compressible(resp.headers.get('Content-Type')):
+            return resp
+        body = resp.body
+        if not isinstance(body, bytes):
+            return resp
+        add_vary(resp.headers, 'Accept-Encoding')
+        encoding = accepted_encoding(request)
+        if encoding is None or len(body) < configs.compress.min_size:
+            return resp
+        level = compress_levels[encoding]
+        if len(body) >= configs.compress.executor_size:
+            # 大的响应在线程池中压缩，不阻塞事件循环
+            body = await asyncio.get_event_loop().run_in_executor(None, compress.compress, body, encoding, level)
+        else:
+            body = compress.compress(body, encoding, level)
+        resp.body = body
+        resp.headers['Content-Encoding'] = encoding
+        return resp
+    return compress_middleware
+
+
 async def response_factory(app, handler):
     async def response_middleware(request):
         r = await handler(request)
@@ -232,11 +406,19 @@ async def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                if jsonutil.is_large(r, configs.json.stream_items):
+                    return await jsonutil.stream_response(request, r, configs.json.chunk_items)
+                resp = web.Response(body=jsonutil.dumps(r))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
-                resp = web.Response(body=app['__template_env__'].get_template(template).render(**r).encode('utf-8'))
+                key = r.get('__render_key__')
+                if key is None or not configs.cache.render_in_executor:
+                    body = render(app, template, r)
+                else:
+                    # 在线程池中渲染，并发的相同渲染只执行一次
+                    body = await render_flight.do((template, key, _page_version), asyncio.get_event_loop().run_in_executor, None, render, app, template, r)
+                resp = web.Response(body=body)
                 resp.content_type = 'text/html;charset=utf-8'
                 return resp
         if isinstance(r, int) and r >= 100 and r < 600:
@@ -253,7 +435,7 @@ async def response_factory(app, handler):
 
 async def auth_factory(app, handler):
     async def auth_middleware(request):
-        if not request.path.startswith('/static'):
+        if not request.path.startswith(('/static', '/assets')):
             logging.info('check user: %s %s' % (request.method, request.path))
             request.__user__ = None
             cookie_str = request.cookies.get(configs.cookie.name)
@@ -268,6 +450,17 @@ async def auth_factory(app, handler):
     return auth_middleware
 
 
+# 已登录用户记录缓存，验证cookie时不必每次查询数据库
+user_cache = LRUCache(configs.cache.user_size, ttl=configs.cache.user_ttl)
+
+
+def invalidate_user(uid):
+    '''
+    Must be called after the password of user is changed or user is deleted.
+    '''
+    user_cache.pop(uid)
+
+
 def user2cookie(user, max_age):
     '''
     Generate cookie str by userid-expires-sha1.
@@ -291,13 +484,18 @@ async def cookie2user(cookie_str):
         uid, expires, sha1 = L
         if int(expires) < time.time():
             return None
-        user = await User.find(uid)
+        user = user_cache.get(uid)
         if user is None:
-            return None
+            user = await User.find(uid)
+            if user is None:
+                return None
+            user_cache.set(uid, user)
         s = '%s-%s-%s-%s' % (uid, user.password, expires, configs.cookie.key)
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
+        # 返回副本，缓存中的记录保留密码用于校验
+        user = User(**user)
         user.password = '******'
         return user
     except Exception as e:
@@ -310,9 +508,11 @@ class Page(object):
     Page object for display pages.
     '''
 
-    def __init__(self, item_count, page_index=1, item_page=10, page_show=3):
+    def __init__(self, item_count, page_index=1, item_page=10, page_show=3, cursor=None):
         '''
         Init Pagination by item_count, page_index and item_page.
+        If a valid cursor is given, page_index is taken from cursor and items are
+        found by keyset pagination, see findArgs().
 
         >>> p1 = Page(100, 1)
         >>> p1.page_count
@@ -335,7 +535,15 @@ class Page(object):
         90
         >>> p3.limit
         10
+        >>> p4 = Page(100, 1, cursor=Page.encodeCursor('after', 1.5, 'id1', 5))
+        >>> p4.page_index
+        5
+        >>> p4.findArgs()
+        {'after': (1.5, 'id1'), 'limit': 10}
         '''
+        seek = self.decodeCursor(cursor) if cursor else None
+        if seek is not None:
+            page_index = seek[3]
         self.item_count = item_count
         self.item_page = item_page
         self.page_count = item_count // item_page + (1 if item_count % item_page > 0 else 0)
@@ -350,6 +558,9 @@ class Page(object):
             self.limit = self.item_page
         self.has_next = self.page_index < self.page_count
         self.has_pre = self.page_index > 1
+        self._seek = seek if self.limit else None
+        self.next_cursor = None
+        self.prev_cursor = None
 
     def __str__(self):
         return 'item_count: %s, page_count: %s, page_index: %s, item_page: %s, offset: %s, limit: %s' % \
@@ -368,6 +579,47 @@ class Page(object):
             p = 1
         return p
 
+    @classmethod
+    def encodeCursor(cls, direction, value, pk, page_index):
+        # 游标内容为[方向, 排序键值, 主键, 页码]，对客户端不透明
+        s = json.dumps([direction, value, pk, page_index], separators=(',', ':'))
+        return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+    @classmethod
+    def decodeCursor(cls, cursor):
+        try:
+            s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+            direction, value, pk, page_index = json.loads(s)
+        except (ValueError, TypeError):
+            logging.info('invalid cursor: %s' % cursor)
+            return None
+        if direction not in ('after', 'before') or not isinstance(page_index, int) or page_index < 1:
+            return None
+        # 排序键值和主键作为SQL参数，只接受数字和字符串
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or not isinstance(pk, str):
+            return None
+        return direction, value, pk, page_index
+
+    def findArgs(self, key='created_at', pk='id'):
+        '''
+        Keyword args of Model.findAll() to get items of this page, ordered by key desc.
+        '''
+        if self._seek is not None:
+            direction, value, pk_value = self._seek[:3]
+            return {direction: (value, pk_value), 'limit': self.limit}
+        return dict(orderBy='`%s` desc, `%s` desc' % (key, pk), limit=(self.offset, self.limit))
+
+    def setCursors(self, items, key='created_at', pk='id'):
+        '''
+        Set next_cursor and prev_cursor by the first and last item of this page.
+        '''
+        if not items:
+            return
+        if self.has_next:
+            self.next_cursor = self.encodeCursor('after', items[-1][key], items[-1][pk], self.page_index + 1)
+        if self.has_pre:
+            self.prev_cursor = self.encodeCursor('before', items[0][key], items[0][pk], self.page_index - 1)
+
     def pagelist(self):
         left = 2
         right = self.page_count